@@ -4,6 +4,7 @@ from typing import Match, Set, Type, TypeVar, ClassVar
 import aiohttp
 from discord import Message, Color
 from MoMMI.commands import command
+from MoMMI.ratelimit import MRateLimit
 from MoMMI.channel import MChannel
 from MoMMI.role import MRoleType
 from MoMMI.handler import MHandler
@@ -16,7 +17,8 @@ COLOR_RUN_SUCCESS  = Color(0x1ECF25)
 COLOR_RUN_FAIL     = Color(0xC0C333)
 COLOR_COMPILE_FAIL = Color(0xF90E0E)
 #                     ```(?:([^\n]*)\n)?(.*)```
-@command("runcode", r"\s*```(?:(?P<Language>[^\r\n]*)\r?\n)?(?P<Code>.*)```", flags=re.DOTALL)
+@command("runcode", r"\s*```(?:(?P<Language>[^\r\n]*)\r?\n)?(?P<Code>.*)```", flags=re.DOTALL,
+         rate_limit=MRateLimit(per_user=(3, 60), per_channel=(6, 60)))
 async def runcode_command(channel: MChannel, match: Match, message: Message) -> None:
     language = match.group("Language")
     code = match.group("Code") or ""
@@ -36,11 +38,9 @@ async def runcode_command(channel: MChannel, match: Match, message: Message) ->
         await channel.send(f"No language with key: `{language}`. You probably didn't intend this so don't put any code on the same line as the opening backticks. That'll fix it.")
 
 
-@command("runcode_file", "")
+# The regex matches any mention, so without needs_attachments every mention would eat rate limit tokens.
+@command("runcode_file", "", needs_attachments=True, rate_limit=MRateLimit(per_user=(3, 60), per_channel=(6, 60)))
 async def runcode_file_command(channel: MChannel, match: Match, message: Message) -> None:
-    if not message.attachments:
-        return
-
     async with aiohttp.ClientSession(headers={"User-Agent": "MoMMIv2 (GitHub @PJBot, GitHub @PJB3005)"}) as session:
         for i, attach in enumerate(message.attachments):
             filename = FILE_EXTENSION_RE.match(attach["filename"])
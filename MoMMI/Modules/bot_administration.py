@@ -3,6 +3,7 @@ from typing import Match
 import aiohttp
 from discord import Message
 from MoMMI.commands import command
+from MoMMI.config import ConfigError
 from MoMMI.master import master
 from MoMMI.server import MChannel
 from MoMMI.role import MRoleType
@@ -19,6 +20,19 @@ async def reload(channel: MChannel, match: Match, message: Message) -> None:
         await master.client.add_reaction(message, "👌")
 
 
+@command("reloadconfig", "reloadconfig", roles=[MRoleType.OWNER])
+async def reloadconfig(channel: MChannel, match: Match, message: Message) -> None:
+    try:
+        await master.reload_config()
+
+    except ConfigError as e:
+        await channel.send(f"Not reloading, the config is broken: {e}")
+        await master.client.add_reaction(message, "🤒")
+
+    else:
+        await master.client.add_reaction(message, "👌")
+
+
 @command("modules", "modules", roles=[MRoleType.OWNER])
 async def modules(channel: MChannel, match: Match, message: Message) -> None:
     msg = "```"
@@ -63,3 +77,69 @@ async def avatar_command(channel: MChannel, match: Match, message: Message) -> N
 @command("save", r"save", roles=[MRoleType.OWNER])
 async def save_command(channel: MChannel, match: Match, message: Message) -> None:
     await master.save_all_storage()
+
+
+@command("dispatch", r"dispatch", roles=[MRoleType.OWNER])
+async def dispatch_command(channel: MChannel, match: Match, message: Message) -> None:
+    if master.scheduler is None:
+        return
+
+    stats = master.scheduler.stats()
+    msg = "```"
+    for key, value in stats.items():
+        msg += f"{key}: {value}\n"
+
+    msg += f"this channel: {master.scheduler.queue_depth(channel)} queued\n"
+
+    wait = master.metrics.get_histogram("send_queue_wait")
+    backlog = sum(x.send_queue.depth for x in master.iter_channels() if x.send_queue is not None)
+    msg += f"send queue: {backlog} waiting, wait p50 {wait.percentile(50):.0f}ms, p99 {wait.percentile(99):.0f}ms\n"
+    msg += f"coalesced sends: {master.metrics.counters.get('send_coalesced', 0)}\n"
+    msg += "```"
+
+    await channel.send(msg)
+
+
+@command("handlerstats", r"handlerstats(?:\s+(total|p99|max|calls|errors))?", roles=[MRoleType.OWNER])
+async def handlerstats_command(channel: MChannel, match: Match, message: Message) -> None:
+    sort = match.group(1) or "total"
+    msg = f"```Top handlers by {sort}:\n"
+    for key, stats in master.metrics.top_handlers(sort):
+        latency = stats.latency
+        msg += f"{key}: {stats.calls} calls, {stats.errors} errors, "
+        msg += f"p50 {latency.percentile(50):.0f}ms, p99 {latency.percentile(99):.0f}ms, "
+        msg += f"max {latency.max_ms:.0f}ms, total {latency.total_ms / 1000:.1f}s\n"
+
+    msg += "```"
+
+    await channel.send(msg)
+
+
+def format_bytes(amount: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if amount < 1024:
+            return f"{amount:.0f}{unit}"
+
+        amount /= 1024
+
+    return f"{amount:.1f}GiB"
+
+
+@command("storagestats", r"storagestats(?:\s+(size|memory|saves))?", roles=[MRoleType.OWNER])
+async def storagestats_command(channel: MChannel, match: Match, message: Message) -> None:
+    sort = match.group(1) or "size"
+    sortkey = {"size": "size", "memory": "memory", "saves": "saves_per_hour"}[sort]
+    entries = [(f"{scope}/{key}", stats) for scope, report in master.storage_report().items() for key, stats in report.items()]
+    entries.sort(key=lambda x: x[1][sortkey], reverse=True)
+
+    total_size = sum(stats["size"] for _, stats in entries)
+    total_memory = sum(stats["memory"] for _, stats in entries)
+    msg = f"```Storage by {sort}, {format_bytes(total_size)} stored, ~{format_bytes(total_memory)} in memory:\n"
+    for key, stats in entries[:15]:
+        memory = f"~{format_bytes(stats['memory'])}" if stats["loaded"] else "not loaded"
+        msg += f"{key}: {format_bytes(stats['size'])} stored, {memory}, "
+        msg += f"{stats['saves']} saves ({stats['saves_per_hour']}/h), last save {stats['last_save_ms']:.0f}ms\n"
+
+    msg += "```"
+
+    await channel.send(msg)
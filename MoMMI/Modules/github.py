@@ -13,10 +13,12 @@ from discord import Color, Embed, Message, User
 from MoMMI.channel import MChannel
 from MoMMI.commloop import comm_event, global_comm_event
 from MoMMI.commands import always_command
+from MoMMI.context import MMessageContext
 from MoMMI.master import master
 from MoMMI.server import MServer
 from MoMMI.Modules.irc import irc_transform
 from MoMMI import command
+from MoMMI.ratelimit import MRateLimit
 import random
 
 logger = logging.getLogger(__name__)
@@ -52,6 +54,90 @@ def is_repo_muted(repo: str) -> bool:
     return repo in EVENT_MUTED_REPOS
 
 
+class GitHubRepoConfig(object):
+    """
+    One entry of a server's modules.github.repos.
+    """
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.repo: str = config["repo"]
+        self.prefix: Optional[str] = config.get("prefix")
+        self.prefix_required: bool = config.get("prefix_required", True)
+        # Channels (by internal name) where the prefix isn't required.
+        self.prefix_whitelist: Set[str] = set(config.get("prefix_whitelist", []))
+        self.branch: str = config.get("branch", "master")
+
+
+class GitHubServerConfig(object):
+    """
+    A server's modules.github.repos, compiled so finding the repos a reference like [123] or [prefix#123] applies to
+    is a dict lookup instead of checking every repo. See get_github_config.
+    """
+
+    def __init__(self, configs: List[Dict[str, Any]]) -> None:
+        self.repos: List[GitHubRepoConfig] = []
+        for config in configs:
+            try:
+                self.repos.append(GitHubRepoConfig(config))
+
+            except (KeyError, TypeError):
+                logger.error(f"Ignoring broken GitHub repo config {config!r}.")
+
+        # Everything below keeps config order.
+        self.by_prefix: DefaultDict[str, List[GitHubRepoConfig]] = defaultdict(list)
+        # Repos references without prefix go to, on any channel.
+        self.unprefixed: List[GitHubRepoConfig] = []
+        # Same but by channel internal name, for channels where some repos don't require a prefix.
+        self.unprefixed_by_channel: Dict[str, List[GitHubRepoConfig]] = {}
+        for repo in self.repos:
+            if repo.prefix is not None:
+                self.by_prefix[repo.prefix].append(repo)
+
+            if not repo.prefix_required:
+                self.unprefixed.append(repo)
+
+        for name in set().union(*(repo.prefix_whitelist for repo in self.repos)):
+            self.unprefixed_by_channel[name] = [
+                repo for repo in self.repos if not repo.prefix_required or name in repo.prefix_whitelist]
+
+    def repos_for(self, channel: MChannel, prefix: Optional[str]) -> List[GitHubRepoConfig]:
+        """
+        The repos a reference with prefix (None if it has none) on channel is about, in config order.
+        """
+        if prefix is not None:
+            return self.by_prefix.get(prefix, [])
+
+        if channel.internal_name is not None:
+            return self.unprefixed_by_channel.get(channel.internal_name, self.unprefixed)
+
+        return self.unprefixed
+
+
+# Compiled configs by server ID, along with the config generation they were compiled at.
+GITHUB_CONFIGS: Dict[int, Tuple[int, Optional[GitHubServerConfig]]] = {}
+
+
+def get_github_config(channel: MChannel) -> Optional[GitHubServerConfig]:
+    """
+    The compiled GitHub config of the server of channel, None if it has none.
+    Compiled once and kept until the config is reloaded.
+    """
+    generation = master.config.generation
+    cached = GITHUB_CONFIGS.get(channel.server.id)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+
+    try:
+        configs: List[Dict[str, Any]] = channel.server_config("modules.github.repos")
+        config: Optional[GitHubServerConfig] = GitHubServerConfig(configs)
+
+    except ValueError:
+        config = None
+
+    GITHUB_CONFIGS[channel.server.id] = generation, config
+    return config
+
+
 async def load(loop: asyncio.AbstractEventLoop) -> None:
     if not master.has_cache(GITHUB_SESSION):
         headers = {
@@ -331,46 +417,48 @@ async def issue_auto_label(type: str, message: Any, meta: str) -> None:
 # handling of stuff like [2000] and [world.dm]
 
 
-@always_command("github_issue")
-async def issue_command(channel: MChannel, match: Match, message: Message) -> None:
-    try:
-        cfg: List[Dict[str, Any]] = channel.server_config("modules.github.repos")
-    except:
+# Every kind of reference we handle is in square brackets.
+@always_command("github_issue", contains="[", context=True)
+async def issue_command(channel: MChannel, match: Match, message: Message, context: MMessageContext) -> None:
+    cfg = get_github_config(channel)
+    if cfg is None:
         # Server has no config settings for GitHub.
         return
 
     asyncio.ensure_future(try_handle_file_embeds(message.content, channel, cfg))
 
-    messages = 0
+    # Sort every reference into the repos it's about first, that's a lookup per reference.
+    issues: DefaultDict[GitHubRepoConfig, List[int]] = defaultdict(list)
+    for match in context.find_all(REG_ISSUE):
+        prefix = match.group(1)
+        issueid = int(match.group(2))
+        if not prefix and issueid < 30:
+            continue
 
-    for repo_config in cfg:
-        repo = repo_config["repo"]
+        for repo_config in cfg.repos_for(channel, prefix):
+            issues[repo_config].append(issueid)
 
-        for match in REG_ISSUE.finditer(message.content):
-            #logger.debug("did match")
-            prefix = match.group(1)
+    commits: DefaultDict[GitHubRepoConfig, List[str]] = defaultdict(list)
+    for match in context.find_all(REG_COMMIT):
+        for repo_config in cfg.repos_for(channel, match.group(1)):
+            commits[repo_config].append(match.group(2))
 
-            if not is_repo_valid_for_command(repo_config, channel, prefix):
-                continue
+    if not issues and not commits:
+        return
 
-            issueid = int(match.group(2))
-            if not prefix and issueid < 30:
-                continue
+    messages = 0
+
+    for repo_config in cfg.repos:
+        repo = repo_config.repo
 
-            #logger.debug("You what")
+        for issueid in issues.get(repo_config, []):
             await post_embedded_issue_or_pr(channel, repo, issueid)
 
             messages += 1
             if messages >= GITHUB_ISSUE_MAX_MESSAGES:
                 return
 
-        for match in REG_COMMIT.finditer(message.content):
-            prefix = match.group(1)
-
-            if not is_repo_valid_for_command(repo_config, channel, prefix):
-                continue
-
-            sha = match.group(2)
+        for sha in commits.get(repo_config, []):
             url = github_url(f"/repos/{repo}/git/commits/{sha}")
             try:
                 commit = await get_github_object(url)
@@ -397,18 +485,16 @@ async def issue_command(channel: MChannel, match: Match, message: Message) -> No
                 return
 
 
-async def try_handle_file_embeds(message: str, channel: MChannel, cfg: List[Dict[str, str]]) -> bool:
+async def try_handle_file_embeds(message: str, channel: MChannel, cfg: GitHubServerConfig) -> bool:
     if not REG_PATH.search(message):
         return False
 
-    prefixes: List[Optional[str]] = [None]
-    paths: List[Tuple[str, Optional[str], Optional[str], bool, Optional[str]]]
-    paths = []
+    # Paths to look for by the repos they're about.
+    paths: DefaultDict[GitHubRepoConfig, List[Tuple[str, Optional[str], Optional[str], bool]]]
+    paths = defaultdict(list)
     color: Union[str, Color] = None
     for match in REG_PATH.finditer(message):
         prefix = match.group(1)
-        if prefix is not None and prefix not in prefixes:
-            prefixes.append(prefix)
         path = match.group(2).lower()
         # Ignore tiny paths, too common accidentally in code blocks.
         if len(path) <= 3:
@@ -426,21 +512,18 @@ async def try_handle_file_embeds(message: str, channel: MChannel, cfg: List[Dict
             if match.group(4):
                 lineend = match.group(4)
 
-        paths.append((path, linestart, lineend, rooted, prefix))
+        for repocfg in cfg.repos_for(channel, prefix):
+            paths[repocfg].append((path, linestart, lineend, rooted))
 
     # That's reponame: list((title, url))
     output: DefaultDict[str, List[Tuple[str, str]]] = defaultdict(list)
 
-    for repocfg in cfg:
-        for theprefix in prefixes:
-            if is_repo_valid_for_command(repocfg, channel, theprefix):
-                break
-
-        else:
+    for repocfg in cfg.repos:
+        if repocfg not in paths:
             continue
 
-        repo = repocfg["repo"]
-        branchname = repocfg.get("branch", "master")
+        repo = repocfg.repo
+        branchname = repocfg.branch
 
         url = github_url(f"/repos/{repo}/branches/{branchname}")
         branch = await get_github_object(url)
@@ -449,10 +532,7 @@ async def try_handle_file_embeds(message: str, channel: MChannel, cfg: List[Dict
             f"/repos/{repo}/git/trees/{branch['commit']['sha']}")
         tree = await get_github_object(url, params={"recursive": "1"})
 
-        for path, linestart, lineend, rooted, nottheprefix in paths:
-            if not is_repo_valid_for_command(repocfg, channel, nottheprefix):
-                continue
-
+        for path, linestart, lineend, rooted in paths[repocfg]:
             for filehash in tree["tree"]:
                 if rooted:
                     if not filehash["path"].lower().startswith(path):
@@ -611,40 +691,12 @@ async def get_github_object(url: str, *, params: Optional[Dict[str, str]] = None
     return contents
 
 
-def is_repo_valid_for_command(repo_config: Dict[str, Any], channel: MChannel, prefix: Optional[str]) -> bool:
-    """
-    Checks to see whether commands like [123] are valid for a certain repo on a certain channel.
-    """
-    repo_prefix = repo_config.get("prefix")
-    repo_prefix_required = repo_config.get("prefix_required", True)
-    repo_prefix_whitelist = repo_config.get("prefix_whitelist", [])
-
-    if channel.internal_name is not None and channel.internal_name in repo_prefix_whitelist:
-        repo_prefix_required = False
-
-    if prefix is not None and repo_prefix != prefix:
-        return False
-
-    if prefix is None and repo_prefix_required:
-        return False
-
-    return True
-
-
 async def get_gh_help(channel: MChannel, message: Message) -> str:
-    try:
-        cfg: List[Dict[str, Any]] = channel.server_config("modules.github.repos")
-    except:
+    cfg = get_github_config(channel)
+    if cfg is None:
         return "This server has no repo configs. Sorry lad."
 
-    has_nonprefixed = False
-
-    for repo_config in cfg:
-        if not repo_config.get("prefix_required", True):
-            has_nonprefixed = True
-            break
-
-    if has_nonprefixed:
+    if cfg.unprefixed:
         desc = """MoMMI can look up issues, commits and files in GitHub repos for you. Syntax is as follows:
     `[number]`: issue/PR lookup.
     `[commit hash]`: commit lookup.
@@ -658,9 +710,9 @@ For refinement (and to look up in certain repos) you can specify "prefixes":
 FOR THIS DISCORD SERVER, the following repos are available, including their prefix and if it's required or not.
 """
 
-        for repo_config in cfg:
-            desc += f"* `{repo_config['repo']}`: `{repo_config['prefix']}`"
-            if repo_config.get("prefix_required", True):
+        for repo_config in cfg.repos:
+            desc += f"* `{repo_config.repo}`: `{repo_config.prefix}`"
+            if repo_config.prefix_required:
                 desc += ", prefix required\n"
             else:
                 desc += "\n"
@@ -674,8 +726,8 @@ FOR THIS DISCORD SERVER, the following repos are available, including their pref
 These prefixes are per-repo identifiers. FOR THIS DISCORD SERVER, the following repos are available:
 """
 
-        for repo_config in cfg:
-            desc += f"* `{repo_config['repo']}`: `{repo_config['prefix']}`\n"
+        for repo_config in cfg.repos:
+            desc += f"* `{repo_config.repo}`: `{repo_config.prefix}`\n"
 
     return desc
 
@@ -702,11 +754,11 @@ async def jenkins_handicap_support(type: str, message: Any, meta: str) -> None:
     if command:
         subprocess.Popen([command])
 
-@command("giveissue", r"giveissue(?:\s+(-\w+=\w+(?:\s+-\w+=\w+)*))?")
+@command("giveissue", r"giveissue(?:\s+(-\w+=\w+(?:\s+-\w+=\w+)*))?",
+         rate_limit=MRateLimit(per_user=(2, 30), total=(10, 60)))
 async def giveissue_command(channel: MChannel, match: Match, message: Message) -> None:
-    try:
-        cfg: List[Dict[str, Any]] = channel.server_config("modules.github.repos")
-    except:
+    cfg = get_github_config(channel)
+    if cfg is None:
         # Server has no config settings for GitHub.
         logger.error(f"giveissue didn't find server config")
         await master.client.add_reaction(message, "❌")
@@ -741,11 +793,8 @@ async def giveissue_command(channel: MChannel, match: Match, message: Message) -
 
     #logger.debug("uh oh")
     didthedeed = 0
-    for repo_config in cfg:
-        repo = repo_config["repo"]
-
-        if not is_repo_valid_for_command(repo_config, channel, prefix):
-            continue
+    for repo_config in cfg.repos_for(channel, prefix):
+        repo = repo_config.repo
         didthedeed = 1
 
         url = github_url(f"/repos/{repo}/issues")
@@ -809,12 +858,12 @@ async def giveissue_command(channel: MChannel, match: Match, message: Message) -
 @command("autolabels", r"(?:(\S+)#)?(?:autolabels|autolabel)")
 async def autolabels_command(channel: MChannel, match: Match, message: Message) -> None:
     prefix = match.group(1)
+    cfg = get_github_config(channel)
+    if cfg is None:
+        return
 
-    for repo_config in cfg:
-        repo = repo_config["repo"]
-
-        if not is_repo_valid_for_command(repo_config, channel, prefix):
-            continue
+    for repo_config in cfg.repos_for(channel, prefix):
+        repo = repo_config.repo
 
         autolabels: Dict[str, str] = master.config.get_module(
                 f"github.repos.{repo}.autolabels", {})
@@ -823,8 +872,7 @@ async def autolabels_command(channel: MChannel, match: Match, message: Message)
         else:
             embed = Embed()
             embed.title = f"Autolabels for {repo}"
-            for label in autolabels:
-                embed.description += f"{label} <> {autolabel.get(label)}\n"
+            embed.description = "".join(f"{label} <> {autolabels[label]}\n" for label in autolabels)
 
             await channel.send(embed=embed)
 
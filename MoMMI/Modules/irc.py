@@ -8,6 +8,7 @@ from MoMMI.handler import MHandler
 from MoMMI.master import master
 from MoMMI.server import MChannel
 from MoMMI.commands import always_command
+from MoMMI.context import MMessageContext
 from MoMMI.types import SnowflakeID
 
 # List of messages relayed to IRC. Prevent getting kicked for repeated messages.
@@ -133,7 +134,6 @@ class IrcConnection:
 
 
     async def message(self, nick: str, target: str, message: str, **kwargs: Any) -> None:
-        from MoMMI.util import utcnow
         if nick in IGNORED_NAMES:
             return
 
@@ -143,7 +143,7 @@ class IrcConnection:
             # Channel we don't know about, probably a PM or something.
             return
 
-        messagelogger.info(f"[{utcnow().isoformat()}](IRC {target}) {nick}: {message}")
+        messagelogger.info("(IRC %s) %s: %s", target, nick, message)
 
         for handler in discord_target.iter_handlers(MDiscordTransform):
             message = await handler.transform(message, nick, discord_target, self.client)
@@ -185,11 +185,18 @@ async def unload(loop: asyncio.AbstractEventLoop) -> None:
 
     master.del_cache("irc_client_list")
 
-@always_command("irc_relay", unsafe=True)
-async def ircrelay(channel: MChannel, match: Match, message: Message) -> None:
-    content = message.content
-    for attachment in message.attachments:
-        content += " " + attachment["url"]
+def is_irc_relay_channel(channel: MChannel) -> bool:
+    for connection in channel.server.master.cache["irc_client_list"].values():
+        for _, discord_channel in connection.channels:
+            if channel.id == discord_channel:
+                return True
+
+    return False
+
+
+@always_command("irc_relay", unsafe=True, ignore_relayed=True, channel_filter=is_irc_relay_channel, context=True)
+async def ircrelay(channel: MChannel, match: Match, message: Message, context: MMessageContext) -> None:
+    content = context.content_with_attachments
 
     if not content or content[0] == "\u200B":
         return
@@ -6,6 +6,7 @@ from collections import defaultdict
 from typing import DefaultDict, Match, Iterable
 from discord import Message
 from MoMMI.commands import command, always_command
+from MoMMI.context import MMessageContext
 from MoMMI.server import MChannel
 from MoMMI import SnowflakeID
 
@@ -18,14 +19,16 @@ ROLE_RE = re.compile(r"<@&(\d+)>")
 logger = logging.getLogger(__name__)
 partial = functools.partial(defaultdict, int)
 
-@always_command("markov_read")
-async def markov_reader(channel: MChannel, match: Match, message: Message) -> None:
+# A sentence needs at least 7 words to be read, so at least 13 characters.
+@always_command("markov_read", min_length=13, context=True)
+async def markov_reader(channel: MChannel, match: Match, message: Message, context: MMessageContext) -> None:
     # if not isbanned(message.author, bantypes.markov):
 
-    content = PARENT_RE.sub("", message.content.lower())
+    content = PARENT_RE.sub("", context.lowered)
     # Because chain is a referenced object.
-    # We do not need to reset it explicitly.
+    # We do not need to reset it explicitly, only mark it as changed.
     chain: CHAIN_TYPE
+    await channel.load_storage("markov")
     try:
         chain = channel.get_storage("markov")
     except KeyError:
@@ -37,6 +40,7 @@ async def markov_reader(channel: MChannel, match: Match, message: Message) -> No
         if len(words) < 7:
             continue
 
+        channel.mark_storage_dirty("markov")
         last = ""
 
         for word in words:
@@ -50,6 +54,7 @@ async def markov_reader(channel: MChannel, match: Match, message: Message) -> No
 
 @command("markov", r"markov\s*(?:\(?(\S*)\)?)?")
 async def markov(channel: MChannel, match: Match, message: Message) -> None:
+    await channel.load_storage("markov")
     try:
         chain = channel.get_storage("markov")
     except:
@@ -9,6 +9,7 @@ import pytz
 from discord import Message, Embed
 from MoMMI import MChannel, command, master, SnowflakeID, add_reaction, MRoleType
 from MoMMI.Modules.help import register_help
+from MoMMI.storageformat import JSON_CODEC, register_codec
 
 LOOP_TASK_CACHE = "reminder_task"
 REMINDER_QUEUE = "reminder_queue"
@@ -21,6 +22,10 @@ RELATIVE_DATE_VERIFY_RE = re.compile(r"^(?:\d+[dhmsw])+$")
 # Tuple format: time, message, server, channel, member, uid
 REMINDER_TUPLE_TYPE = Tuple[datetime, str, SnowflakeID, SnowflakeID, SnowflakeID, int]
 
+
+register_codec(REMINDER_UID, JSON_CODEC)
+
+
 async def load(loop: asyncio.AbstractEventLoop) -> None:
     task: asyncio.Future
     if master.has_cache(LOOP_TASK_CACHE):
@@ -30,6 +35,7 @@ async def load(loop: asyncio.AbstractEventLoop) -> None:
 
     task = asyncio.ensure_future(reminder_loop())
     master.set_cache(LOOP_TASK_CACHE, task)
+    await master.load_global_storage(REMINDER_QUEUE)
     if not master.has_global_storage(REMINDER_QUEUE):
         master.set_global_storage(REMINDER_QUEUE, [])
 
@@ -68,7 +74,7 @@ async def check_reminders() -> None:
         asyncio.ensure_future(send_reminder(item))
 
     if modified:
-        await master.save_global_storage(REMINDER_QUEUE)
+        master.schedule_global_storage_save(REMINDER_QUEUE)
 
 
 async def send_reminder(reminder: REMINDER_TUPLE_TYPE) -> None:
@@ -124,7 +130,7 @@ async def unremind_command(channel: MChannel, match: Match, message: Message) ->
 
     thelist.remove(found)
     heapq.heapify(thelist)
-    asyncio.ensure_future(master.save_global_storage(REMINDER_QUEUE))
+    master.schedule_global_storage_save(REMINDER_QUEUE)
     await channel.send("And away it goes.")
 
 
@@ -148,11 +154,12 @@ async def remind_command(channel: MChannel, match: Match, message: Message) -> N
     master.set_global_storage(REMINDER_UID, uid + 1)
     reminder = (time, match.group(2), channel.server.id, channel.id, SnowflakeID(message.author.id), uid)
     heapq.heappush(heap, reminder)
+    # Before any await, so the reminder gets saved even if confirming it fails.
+    master.schedule_global_storage_save(REMINDER_QUEUE)
+    master.schedule_global_storage_save(REMINDER_UID)
     pretty = time.strftime("%A %d %B %Y %H:%M:%S **%Z**")
     await channel.send(f"#{uid} coming in at {pretty}")
     asyncio.ensure_future(add_reaction(message, "✅"))
-    asyncio.ensure_future(master.save_global_storage(REMINDER_QUEUE))
-    asyncio.ensure_future(master.save_global_storage(REMINDER_UID))
 
 
 @command("sneakremind", r"sneakremind\s+(\S+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(.+)", roles=[MRoleType.OWNER])
@@ -175,11 +182,12 @@ async def sneakremind_command(channel: MChannel, match: Match, message: Message)
     master.set_global_storage(REMINDER_UID, uid + 1)
     reminder = (time, match.group(5), SnowflakeID(match.group(2)), SnowflakeID(match.group(3)), SnowflakeID(match.group(4)), uid)
     heapq.heappush(heap, reminder)
+    # Before any await, so the reminder gets saved even if confirming it fails.
+    master.schedule_global_storage_save(REMINDER_QUEUE)
+    master.schedule_global_storage_save(REMINDER_UID)
     pretty = time.strftime("%A %d %B %Y %H:%M:%S **%Z**")
     await channel.send(f"#{uid} coming in at {pretty}")
     asyncio.ensure_future(add_reaction(message, "✅"))
-    asyncio.ensure_future(master.save_global_storage(REMINDER_QUEUE))
-    asyncio.ensure_future(master.save_global_storage(REMINDER_UID))
 
 
 def parse_time(timestring: str) -> datetime:
@@ -8,6 +8,7 @@ from subprocess import PIPE
 from typing import Match, Union, Tuple, List
 from discord import Message
 from MoMMI import command, MChannel, add_reaction, remove_reaction, master
+from MoMMI.ratelimit import MRateLimit
 
 LOGGER = getLogger(__name__)
 
@@ -42,7 +43,7 @@ async def get_runtimes(file_date: date, lines_returned: int, condenser_path: str
         return ("\n".join(lines), size, url)
 
 
-@command("runtimelog", r"runtimelog(?:\s+(.*))?")
+@command("runtimelog", r"runtimelog(?:\s+(.*))?", rate_limit=MRateLimit(per_user=(1, 60), total=(3, 60)))
 async def runtimelog_command(channel: MChannel, match: Match, message: Message) -> None:
     try:
         runtime_condenser = channel.module_config("runtimelog.runtime-condenser")
@@ -7,11 +7,12 @@ from urllib.parse import parse_qs
 from discord import Message
 from MoMMI import command, MChannel
 from MoMMI.Modules.help import register_help
+from MoMMI.ratelimit import MRateLimit
 from MoMMI.types import MIdentifier
 
 logger = logging.getLogger(__name__)
 
-@command("serverstatus", r"stat(?:us|su)\s*(\S*)")
+@command("serverstatus", r"stat(?:us|su)\s*(\S*)", rate_limit=MRateLimit(per_user=(3, 30), per_channel=(5, 30)))
 async def serverstatus_command(channel: MChannel, match: Match, message: Message) -> None:
     try:
         config: Dict[str, Any] = channel.server_config("modules.serverstatus")
@@ -1,5 +1,5 @@
 import logging
-from typing import Match, Any, Dict
+from typing import Match, Any, Dict, List
 import aiohttp
 from discord import Message
 from MoMMI import comm_event, command, MChannel, always_command
@@ -30,11 +30,16 @@ async def ss14_nudge(channel: MChannel, message: Any, meta: str) -> None:
 
     await channel.send(final_message)
 
-@always_command("ss14_relay", unsafe=True)
-async def ss14_relay(channel: MChannel, match: Match, message: Message) -> None:
+def is_ss14_relay_channel(channel: MChannel) -> bool:
     if not channel.internal_name:
-        return
+        return False
+
+    configs: List[Dict[str, Any]] = channel.server_config("modules.ss14", [])
+    return any(config["discord_channel"] == channel.internal_name for config in configs)
 
+
+@always_command("ss14_relay", unsafe=True, ignore_relayed=True, channel_filter=is_ss14_relay_channel)
+async def ss14_relay(channel: MChannel, match: Match, message: Message) -> None:
     content = message.content
     content = content.strip()
 
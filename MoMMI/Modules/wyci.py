@@ -3,14 +3,18 @@ import re
 from typing import Match
 from discord import Message
 from MoMMI import master, always_command, MChannel
+from MoMMI.context import MMessageContext
+
+WYCI_RE = re.compile(r"\S\s+(?:when|whence)[\s*?.!)]*$", re.IGNORECASE)
+
+def wyci_enabled(channel: MChannel) -> bool:
+    return channel.server_config("wyci.enabled", True)
 
-@always_command("wyci")
-async def wyci(channel: MChannel, _match: Match, message: Message) -> None:
-    if not channel.server_config("wyci.enabled", True):
-        return
 
-    match = re.search(r"\S\s+(?:when|whence)[\s*?.!)]*$", message.content, re.IGNORECASE)
-    if match is None:
+# "whence" contains "when" so that works out.
+@always_command("wyci", contains="when", channel_filter=wyci_enabled, context=True)
+async def wyci(channel: MChannel, _match: Match, message: Message, context: MMessageContext) -> None:
+    if not context.find_all(WYCI_RE):
         return
 
     if random.random() > 0.005:
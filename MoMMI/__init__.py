@@ -11,12 +11,19 @@ __all__ = ["channel",
            "commands",
            "commloop",
            "config",
+           "context",
            "handler",
            "logsetup",
            "master",
+           "metrics",
            "module",
            "permissions",
+           "ratelimit",
            "role",
+           "router",
+           "scheduler",
+           "sendqueue",
            "server",
+           "storage",
            "types",
            "util"]
@@ -1,11 +1,14 @@
 import logging
-from typing import TYPE_CHECKING, Any, Optional, cast, Type, Iterable, TypeVar
+from typing import TYPE_CHECKING, Any, Optional, cast, Type, Iterable, TypeVar, Set
 from discord import Channel, Role, Member
 from MoMMI.types import SnowflakeID
-from MoMMI.config import get_nested_dict_value, ConfigError
+from MoMMI.config import ConfigError
 from MoMMI.role import MRoleType
 from MoMMI.types import MIdentifier
 
+if TYPE_CHECKING:
+    from MoMMI.sendqueue import MSendQueue
+
 logger = logging.getLogger(__name__)
 T = TypeVar("T")
 
@@ -24,6 +27,8 @@ class MChannel(object):
         self.id: SnowflakeID = SnowflakeID(channel.id)
         self.internal_name: Optional[str] = name
         self.server: MServer = server
+        # Created on the first send.
+        self.send_queue: Optional["MSendQueue"] = None
 
     @property
     def discordpy_channel(self) -> Channel:
@@ -53,9 +58,13 @@ class MChannel(object):
     async def send(self, message: str = "", **kwargs: Any) -> None:
         """
         Send a message on this channel.
+        This goes through the channel's send queue, so it may take a bit if we're sending a lot.
         """
-        channel = self.get_channel()
-        await self.server.master.client.send_message(channel, message, **kwargs)
+        from MoMMI.sendqueue import MSendQueue
+        if self.send_queue is None:
+            self.send_queue = MSendQueue(self)
+
+        await self.send_queue.send(message, **kwargs)
 
     def module_config(self, key: str, default: Optional[T] = None) -> T:
         """
@@ -67,7 +76,7 @@ class MChannel(object):
         return self.server.master.config.get_main(key, default)
 
     def server_config(self, key: str, default: Optional[T] = None) -> T:
-        ret = cast(Optional[T], get_nested_dict_value(self.server.config, key))
+        ret = cast(Optional[T], self.server.config_lookup.get(key))
         if ret is not None:
             return ret
 
@@ -76,7 +85,11 @@ class MChannel(object):
 
         return default
 
-    def isrole(self, member: Member, rolename: MRoleType) -> bool:
+    def isrole(self, member: Member, rolename: MRoleType, member_roles: Optional[Set[SnowflakeID]] = None) -> bool:
+        """
+        Checks whether a member has a role.
+        member_roles can be passed if the member's role IDs are known already, like from an MMessageContext.
+        """
         owner_id: int = self.main_config("bot.owner")
         if int(member.id) == owner_id:
             return True
@@ -86,15 +99,13 @@ class MChannel(object):
 
         snowflake = self.server.roles[rolename]
 
-        for role in member.roles:
-            if SnowflakeID(role.id) in snowflake:
-                return True
+        if member_roles is None:
+            member_roles = {SnowflakeID(role.id) for role in member.roles}
 
-        return False
+        return not snowflake.isdisjoint(member_roles)
 
     def iter_handlers(self, handlertype: Type[T]) -> Iterable[T]:
-        for module in self.server.modules.values():
-            yield from (x for x in module.handlers.values() if isinstance(x, handlertype))
+        return self.server.get_handlers(handlertype)
 
     def get_storage(self, name: str) -> Any:
         return self.server.get_storage(name)
@@ -102,9 +113,18 @@ class MChannel(object):
     def set_storage(self, name: str, value: Any) -> None:
         self.server.set_storage(name, value)
 
+    async def load_storage(self, name: str) -> None:
+        await self.server.load_storage(name)
+
+    def mark_storage_dirty(self, name: str) -> None:
+        self.server.mark_storage_dirty(name)
+
     async def save_storage(self, name: str) -> None:
         await self.server.save_storage(name)
 
+    def schedule_storage_save(self, name: str) -> None:
+        self.server.schedule_storage_save(name)
+
     async def save_all_storages(self) -> None:
         await self.server.save_all_storages()
 
@@ -2,23 +2,40 @@ import asyncio
 import logging
 import random
 import re
-from typing import Callable, Match, Pattern, Awaitable, Optional, List, Any, TYPE_CHECKING
+import time
+from typing import Callable, Match, Pattern, Awaitable, Optional, List, Any, TypeVar, TYPE_CHECKING
 from discord import Message
 from MoMMI.handler import MHandler
 from MoMMI.permissions import bantypes
+from MoMMI.ratelimit import MRateLimit
 from MoMMI.role import MRoleType
+from MoMMI.types import SnowflakeID
 
 logger = logging.getLogger(__name__)
 chatlogger = logging.getLogger("chat")
 
 if TYPE_CHECKING:
     from MoMMI.channel import MChannel
+    from MoMMI.context import MMessageContext
 
 CommandType = Callable[["MChannel", Match, Message], Awaitable[None]]
-
-
-def command(name: str, regex: str, flags: int = re.IGNORECASE, **kwargs: Any) -> Callable[[CommandType], CommandType]:
-    def inner(function: CommandType) -> CommandType:
+# Commands registered with context=True also get passed the MMessageContext.
+ContextCommandType = Callable[["MChannel", Match, Message, "MMessageContext"], Awaitable[None]]
+AnyCommandType = TypeVar("AnyCommandType", CommandType, ContextCommandType)
+ChannelFilterType = Callable[["MChannel"], bool]
+
+# Messages relayed from IRC and such start with this, to prevent loops.
+RELAYED_MARKER = "\u200B"
+# Reacted to messages that hit a command's rate_limit.
+RATE_LIMITED_REACTION = "⏱"
+
+
+def command(name: str, regex: str, flags: int = re.IGNORECASE, **kwargs: Any) -> Callable[[AnyCommandType], AnyCommandType]:
+    """
+    Registers a command, ran when the bot is mentioned and the rest of the message matches regex.
+    Expensive commands should pass rate_limit=MRateLimit(...), see MoMMI.ratelimit.
+    """
+    def inner(function: AnyCommandType) -> AnyCommandType:
         from MoMMI.master import master
         if not asyncio.iscoroutinefunction(function):
             logger.error(
@@ -33,8 +50,23 @@ def command(name: str, regex: str, flags: int = re.IGNORECASE, **kwargs: Any) ->
     return inner
 
 
-def always_command(name: str, **kwargs: Any) -> Callable[[CommandType], CommandType]:
-    def inner(function: CommandType) -> CommandType:
+def always_command(name: str, **kwargs: Any) -> Callable[[AnyCommandType], AnyCommandType]:
+    """
+    Registers a command that runs on every message, without the bot having to be mentioned.
+    Because these run so often, try to pass some of the cheap pre-filters MCommand accepts,
+    so that the dispatcher can skip the command without calling it:
+
+    contains: lowercase text the (lowercased) message has to contain.
+    min_length/max_length: bounds for the length of the message content.
+    channel_filter: called with an MChannel, the command only runs on channels it returns True for.
+        The result is cached per channel until modules or config get reloaded.
+    ignore_bots: skip messages sent by bot accounts.
+    ignore_relayed: skip messages relayed by MoMMI from somewhere else, like IRC.
+    needs_attachments: skip messages without attachments.
+
+    Like with command, pass context=True to get the MMessageContext passed as fourth argument.
+    """
+    def inner(function: AnyCommandType) -> AnyCommandType:
         from .master import master
         if not asyncio.iscoroutinefunction(function):
             logger.error(
@@ -55,18 +87,30 @@ class MCommand(MHandler):
     def __init__(self,
                  name: str,
                  module: str,
-                 func: CommandType,
+                 func: Callable[..., Awaitable[None]],
                  regex: Optional[Pattern] = None,
                  unsafe: bool = False,
                  prefix: bool = True,
                  commandhelp: Optional[str] = None,
                  roles: Optional[List[MRoleType]] = None,
-                 bans: Optional[List[bantypes]] = None
+                 bans: Optional[List[bantypes]] = None,
+                 contains: Optional[str] = None,
+                 min_length: int = 0,
+                 max_length: Optional[int] = None,
+                 channel_filter: Optional[ChannelFilterType] = None,
+                 ignore_bots: bool = False,
+                 ignore_relayed: bool = False,
+                 needs_attachments: bool = False,
+                 context: bool = False,
+                 rate_limit: Optional[MRateLimit] = None
                  ) -> None:
 
         super().__init__(name, module)
 
-        self.func: CommandType = func
+        self.func: Callable[..., Awaitable[None]] = func
+        # Whether func takes the MMessageContext.
+        self.context: bool = context
+        self.rate_limit: Optional[MRateLimit] = rate_limit
 
         self.regex: Optional[Pattern] = regex
 
@@ -76,6 +120,28 @@ class MCommand(MHandler):
         self.help: Optional[str] = commandhelp
         self.roles: Optional[List[MRoleType]] = roles
 
+        # Pre-filters, checked by the router before the command gets executed.
+        # See always_command for what they do.
+        self.contains: Optional[str] = contains
+        self.min_length: int = min_length
+        self.max_length: Optional[int] = max_length
+        self.channel_filter: Optional[ChannelFilterType] = channel_filter
+        self.ignore_bots: bool = ignore_bots
+        self.ignore_relayed: bool = ignore_relayed
+        self.needs_attachments: bool = needs_attachments
+        self.has_filters: bool = bool(contains or min_length or max_length is not None
+                                      or channel_filter or ignore_bots or ignore_relayed or needs_attachments)
+
+    def match(self, content: str) -> Optional[Match]:
+        """
+        Matches our regex against the message content, with the mention prefix already stripped off.
+        Returns None if the command does not apply.
+        """
+        if self.regex is None:
+            return None
+
+        return self.regex.match(content)
+
     async def try_execute(self, channel: "MChannel", message: Message) -> None:
         message_start = 0
         match = None
@@ -94,15 +160,24 @@ class MCommand(MHandler):
             message_start = match.end()
 
         if self.regex:
-            content = message.content[message_start:]
-            match = self.regex.match(content)
+            match = self.match(message.content[message_start:])
             if match is None:
                 return
 
+        await self.execute(channel, message, match)
+
+    async def execute(self, channel: "MChannel", message: Message, match: Optional[Match], context: Optional["MMessageContext"] = None) -> None:
+        """
+        Runs the command after it has been matched, checking roles first.
+        """
+        from MoMMI.context import MMessageContext
+        if context is None:
+            context = MMessageContext(channel, message)
+
         if self.roles:
             found = False
             for role in self.roles:
-                if channel.isrole(message.author, role):
+                if channel.isrole(message.author, role, context.author_roles):
                     found = True
                     break
 
@@ -112,10 +187,57 @@ class MCommand(MHandler):
                 await channel.send(choice)
                 return
 
+        if self.rate_limit is not None:
+            await self.execute_limited(channel, message, match, context, self.rate_limit)
+            return
+
+        await self.run(channel, message, match, context)
+
+    async def execute_limited(self, channel: "MChannel", message: Message, match: Optional[Match], context: "MMessageContext", limit: MRateLimit) -> None:
+        key = None
+        if limit.coalesce:
+            key = (channel.id, context.content, tuple(context.attachments))
+            existing = limit.in_flight.get(key)
+            if existing is not None:
+                # Identical request already running, its output goes to the same channel so just wait on that.
+                await asyncio.shield(existing)
+                return
+
+        if not limit.try_take(SnowflakeID(message.author.id), channel.id):
+            try:
+                await channel.server.master.client.add_reaction(message, RATE_LIMITED_REACTION)
+            except:
+                logger.exception("Failed to add rate limit reaction.")
+            return
+
+        if key is None:
+            await self.run(channel, message, match, context)
+            return
+
+        future = channel.server.master.client.loop.create_future()
+        limit.in_flight[key] = future
         try:
-            # TODO: type ignore because ALL commands take in a regex match,
+            await self.run(channel, message, match, context)
+
+        finally:
+            del limit.in_flight[key]
+            future.set_result(None)
+
+    async def run(self, channel: "MChannel", message: Message, match: Optional[Match], context: "MMessageContext") -> None:
+        start = time.monotonic()
+        error = False
+        try:
+            # TODO: ALL commands take in a regex match,
             # but that only exists if you give the command decorator an actual regex.
             # Refactor this so that commands that don't take in a match are a different type.
-            await self.func(channel, match, message)  # type: ignore
+            if self.context:
+                await self.func(channel, match, message, context)
+            else:
+                await self.func(channel, match, message)
+
         except:
+            error = True
             logger.exception("Exception in command handler!")
+
+        finally:
+            channel.server.master.metrics.record_handler(self, time.monotonic() - start, error)
@@ -3,8 +3,10 @@ import hmac
 import json
 import logging
 import struct
+import time
+from functools import partial
 from hashlib import sha512
-from typing import Dict, Tuple, Any, Callable, Awaitable, Optional, List, Union
+from typing import Dict, Tuple, Any, Callable, Awaitable, Optional, List, Set, Union
 from MoMMI.channel import MChannel
 from MoMMI.handler import MHandler
 from MoMMI.server import MServer
@@ -19,6 +21,9 @@ ERROR_PACK = struct.pack("!B", 2)
 ERROR_HMAC = struct.pack("!B", 3)
 ERROR_UNKNOWN = struct.pack("!B", 4)
 
+# Messages of a connection that may be being routed at once before we stop reading more.
+ROUTE_BACKLOG = 64
+
 logger = logging.getLogger(__name__)
 
 
@@ -30,14 +35,38 @@ class commloop(object):
 
         self.master = master
 
-        self.routing: Dict[str, Any] = master.config.get_main(
-            "commloop.route", {})
+        self.routing: Dict[str, Any] = {}
+        self.authkey: str = ""
+        self.idle_timeout: float = 60
+        self.handler_timeout: float = 30
+        # Comm event handlers running at once, across all messages.
+        self.max_concurrent: int = 0
+        self.handler_slots = asyncio.Semaphore(1)
+        # Built from routing when first needed, see build().
+        self.table: Optional[Dict[str, MCommRoute]] = None
+        self.load_config()
+        # Changing these takes a restart.
         self.address: str = master.config.get_main(
             "commloop.address", "localhost")
         self.port: int = master.config.get_main("commloop.port", 1679)
-        self.authkey: str = master.config.get_main("commloop.password")
         self.loop = loop
 
+    def load_config(self) -> None:
+        """
+        (Re)loads the routing info, password and handler limits, see MoMMI.reload_config.
+        """
+        self.routing = self.master.config.get_main("commloop.route", {})
+        self.authkey = self.master.config.get_main("commloop.password")
+        self.idle_timeout = self.master.config.get_main("commloop.idle_timeout", 60)
+        self.handler_timeout = self.master.config.get_main("commloop.handler_timeout", 30)
+        max_concurrent: int = self.master.config.get_main("commloop.max_concurrent", 16)
+        if max_concurrent != self.max_concurrent:
+            # Handlers that are running keep (and release) the old semaphore, new ones go by the new limit.
+            self.max_concurrent = max_concurrent
+            self.handler_slots = asyncio.Semaphore(max_concurrent)
+
+        self.invalidate()
+
     async def start(self) -> None:
         self.server = await asyncio.start_server(
             self.accept_client,
@@ -52,6 +81,10 @@ class commloop(object):
             raise RuntimeError("Server is none!")
 
         self.server.close()
+        # Connections stay open after the server's closed, they have to be closed themselves.
+        for _, writer in self.clients.values():
+            writer.close()
+
         await self.server.wait_closed()
 
     def accept_client(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter) -> None:
@@ -67,92 +100,197 @@ class commloop(object):
         task.add_done_callback(client_done)
 
     async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Handles frames from a client until it disconnects or sends nothing for commloop.idle_timeout seconds.
+        Every frame gets its return code as soon as it's read, before it's routed,
+        so clients can send many frames without waiting and read the return codes after.
+        Messages are routed concurrently, just like when every message came in on its own connection.
+        """
+        backlog = asyncio.Semaphore(ROUTE_BACKLOG)
+        routing: Set[asyncio.Future] = set()
         try:
-            # Read ID.
-            data = await reader.read(2)
-            if data != b"\x30\x05":
-                writer.write(ERROR_ID)
-                return
-
-            auth = await reader.read(DIGEST_SIZE)
-
-            length = struct.unpack("!I", await reader.read(4))[0]
-            data = b""
-            while len(data) < length:
-                newdata = await reader.read(length - len(data))
-                if not newdata:
+            while True:
+                try:
+                    code, message = await self.read_frame(reader)
+
+                except asyncio.IncompleteReadError as e:
+                    # Nothing read means a clean disconnect between frames, like every single message client does.
+                    if e.partial:
+                        logger.warning("Commloop client disconnected halfway through a frame.")
                     break
-                data += newdata
 
-            stomach = hmac.new(self.authkey.encode("UTF-8"), data, sha512)
-            if not hmac.compare_digest(stomach.digest(), auth):
-                writer.write(ERROR_HMAC)
-                return
+                except asyncio.TimeoutError:
+                    break
 
-            try:
-                message: Dict[str, Any] = json.loads(data.decode("UTF-8"))
+                writer.write(code)
+                await writer.drain()
+                if message is not None:
+                    await backlog.acquire()
+                    task = asyncio.ensure_future(self.route_safely(message), loop=self.loop)
+                    routing.add(task)
+                    task.add_done_callback(routing.discard)
+                    task.add_done_callback(lambda _: backlog.release())
+
+                elif code != ERROR_PACK:
+                    # Can't trust where the next frame starts, or who we're talking to.
+                    break
 
-            except:
-                writer.write(ERROR_PACK)
-                return
+        except ConnectionError:
+            pass
+
+        except:
+            logger.exception(
+                "Got exception inside main commloop handler. Uh oh!")
+            writer.write(ERROR_UNKNOWN)
 
-            if "type" not in message or "meta" not in message or "cont" not in message:
-                writer.write(ERROR_PACK)
-                return
+        finally:
+            writer.close()
 
-            writer.write(ERROR_OK)
+        # The connection counts as open until everything on it is routed.
+        if routing:
+            await asyncio.wait(routing)
 
+    async def read_frame(self, reader: asyncio.StreamReader) -> Tuple[bytes, Optional[Dict[str, Any]]]:
+        """
+        Reads a frame. Returns its return code, and the message if the code is ERROR_OK, None otherwise.
+        Raises asyncio.IncompleteReadError on disconnect and asyncio.TimeoutError when idle for too long.
+        """
+        # Read ID.
+        data = await asyncio.wait_for(reader.readexactly(2), self.idle_timeout)
+        if data != b"\x30\x05":
+            return ERROR_ID, None
+
+        header = await asyncio.wait_for(reader.readexactly(DIGEST_SIZE + 4), self.idle_timeout)
+        auth = header[:DIGEST_SIZE]
+        length = struct.unpack("!I", header[DIGEST_SIZE:])[0]
+        data = await asyncio.wait_for(reader.readexactly(length), self.idle_timeout)
+
+        stomach = hmac.new(self.authkey.encode("UTF-8"), data, sha512)
+        if not hmac.compare_digest(stomach.digest(), auth):
+            return ERROR_HMAC, None
+
+        try:
+            message: Dict[str, Any] = json.loads(data.decode("UTF-8"))
+
+        except:
+            return ERROR_PACK, None
+
+        if not isinstance(message, dict) or "type" not in message or "meta" not in message or "cont" not in message:
+            return ERROR_PACK, None
+
+        return ERROR_OK, message
+
+    async def route_safely(self, message: Dict[str, Any]) -> None:
+        try:
             await self.route(message)
 
         except:
-            logger.exception(
-                "Got exception inside main commloop handler. Uh oh!")
-            writer.write(ERROR_UNKNOWN)
+            logger.exception("Got exception while routing commloop message.")
+
+    def invalidate(self) -> None:
+        """
+        Drops the routing table, it's rebuilt on the next message.
+        Needed whenever comm event handlers, routing config, servers or channels change.
+        """
+        self.table = None
+
+    def build(self) -> Dict[str, "MCommRoute"]:
+        handlers: Dict[str, MCommEvent] = {}
+        for handler in self.master.get_global_handlers(MCommEvent):
+            # Last one wins if names clash, like it always did.
+            handlers[handler.name] = handler
+
+        table: Dict[str, MCommRoute] = {}
+        for type, metas in self.routing.items():
+            route = table[type] = MCommRoute(handlers.get(type))
+            for meta, channelpairs in metas.items():
+                channels: List[MChannel] = []
+                for channelpair in channelpairs:
+                    try:
+                        servername = verify_tabled_id(channelpair[0])
+                        channelname = verify_tabled_id(channelpair[1])
+                        channels.append(self.master.get_server(servername).get_channel(channelname))
+
+                    except (IndexError, KeyError, TypeError):
+                        logger.warning(f"Can't find channel {channelpair} to route '{type}' '{meta}' to.")
+
+                route.channels[meta] = channels
+
+        self.table = table
+        return table
 
     async def route(self, message: Dict[str, Any]) -> None:
         print(message)
-        # Do global comm events first.
-        for globalhandler in self.master.iter_global_handlers(MGlobalCommEvent):
-            try:
-                await globalhandler.execute(message["type"], message["cont"], message["meta"])
-            except:
-                logger.exception("Exception inside global comm event.")
+        type, cont, meta = message["type"], message["cont"], message["meta"]
+        # Global comm events and the routed handler for every channel all run at once.
+        jobs = [self.run_handler(globalhandler, partial(globalhandler.execute, type, cont, meta))
+                for globalhandler in self.master.iter_global_handlers(MGlobalCommEvent)]
 
-        if message["type"] not in self.routing:
-            logger.warning(
-                f"No routing info for type '$YELLOW{message['type']}$RESET'")
-            return
+        for handler, channel in self.find_targets(type, meta):
+            jobs.append(self.run_handler(handler, partial(handler.execute, channel, cont, meta)))
 
-        handler: Optional[MCommEvent] = None
+        await asyncio.gather(*jobs)
 
-        for module in self.master.modules.values():
-            for p_handler in module.handlers.values():
-                if isinstance(p_handler, MCommEvent) and p_handler.name == message["type"]:
-                    handler = p_handler
-                    break
+    def find_targets(self, type: str, meta: Any) -> List[Tuple["MCommEvent", MChannel]]:
+        table = self.table
+        if table is None:
+            table = self.build()
 
+        route = table.get(type)
+        if route is None:
+            logger.warning(
+                f"No routing info for type '$YELLOW{type}$RESET'")
+            return []
+
+        handler = route.handler
         if handler is None:
             logger.error(
-                f"Found routing information for nonexistant handler \"{message['type']}\".")
-            return
+                f"Found routing information for nonexistant handler \"{type}\".")
+            return []
 
-        channels = self.routing[message["type"]].get(message["meta"])
+        channels = route.channels.get(meta)
         if not channels:
             logger.warning(
-                f"Got message with unconfigured meta '{message['meta']}'")
-            return
+                f"Got message with unconfigured meta '{meta}'")
+            return []
+
+        return [(handler, channel) for channel in channels]
 
-        for channelpair in channels:
-            servername = verify_tabled_id(channelpair[0])
-            channelname = verify_tabled_id(channelpair[1])
+    async def run_handler(self, handler: MHandler, call: Callable[[], Awaitable[None]]) -> None:
+        """
+        Runs a comm event handler once there's room under commloop.max_concurrent, for at most commloop.handler_timeout seconds.
+        Exceptions are logged and go no further, so they can't affect other handlers.
 
-            server: MServer = self.master.get_server(servername)
-            channel = server.get_channel(channelname)
+        The timeout starts once the handler got its slot, waiting for one doesn't count.
+        Waiting on the channel send queues does count, but cancelling a handler doesn't take back
+        messages it already queued, those still get sent.
+        """
+        async with self.handler_slots:
             try:
-                await handler.execute(channel, message["cont"], message["meta"])
+                if self.handler_timeout > 0:
+                    await asyncio.wait_for(call(), self.handler_timeout)
+
+                else:
+                    await call()
+
+            except asyncio.TimeoutError:
+                logger.error(f"Comm event handler {handler.name} took longer than {self.handler_timeout}s, cancelled it.")
+
+            except asyncio.CancelledError:
+                raise
+
             except:
-                logger.exception(
-                    "Caught exception inside commloop event handler.")
+                logger.exception(f"Caught exception inside comm event handler {handler.name}.")
+
+
+class MCommRoute(object):
+    """
+    Where comm events of one type go: the handler, and the channels for every meta.
+    """
+
+    def __init__(self, handler: Optional["MCommEvent"]) -> None:
+        self.handler = handler
+        self.channels: Dict[Any, List[MChannel]] = {}
 
 
 def verify_tabled_id(idname: Any) -> Union[str, SnowflakeID]:
@@ -188,7 +326,16 @@ class MCommEvent(MHandler):
         self.func: CommEventType = func
 
     async def execute(self, channel: MChannel, message: Any, meta: str) -> None:
-        await self.func(channel, message, meta)
+        start = time.monotonic()
+        error = False
+        try:
+            await self.func(channel, message, meta)
+        except:
+            error = True
+            raise
+
+        finally:
+            channel.server.master.metrics.record_handler(self, time.monotonic() - start, error)
 
 
 GlobalCommEventType = Callable[[str, Any, str], Awaitable[None]]
@@ -215,4 +362,14 @@ class MGlobalCommEvent(MHandler):
         self.func: GlobalCommEventType = func
 
     async def execute(self, type: str, message: Any, meta: str) -> None:
-        await self.func(type, message, meta)
+        from MoMMI.master import master
+        start = time.monotonic()
+        error = False
+        try:
+            await self.func(type, message, meta)
+        except:
+            error = True
+            raise
+
+        finally:
+            master.metrics.record_handler(self, time.monotonic() - start, error)
@@ -1,6 +1,6 @@
 import asyncio
 import logging
-from typing import Dict, Any, TypeVar, Optional, cast
+from typing import Dict, Any, TypeVar, Optional, Set, Tuple, cast
 from pathlib import Path
 import aiofiles
 import toml
@@ -13,16 +13,51 @@ T = TypeVar("T")
 class ConfigManager(object):
     def __init__(self) -> None:
         self.path: Optional[Path] = None
-
-        self.main: Dict[str, Any] = {}
-        self.modules: Dict[str, Any] = {}
-        self.servers: Dict[str, Any] = {}
+        # Bumped every time any of the config is replaced,
+        # so anything derived from the config can tell it's stale by remembering the generation it was made at.
+        self.generation = 0
+
+        self.main_lookup = ConfigLookup({})
+        self.modules_lookup = ConfigLookup({})
+        self.servers_lookup = ConfigLookup({})
+        # Config of every server in servers.toml by guild ID.
+        self.servers_by_id: Dict[int, Dict[str, Any]] = {}
+
+    # Replacing a config replaces its lookup cache with it in one assignment,
+    # so nothing can ever read a cached value of the old config out of the new one.
+    @property
+    def main(self) -> Dict[str, Any]:
+        return self.main_lookup.data
+
+    @main.setter
+    def main(self, value: Dict[str, Any]) -> None:
+        self.main_lookup = ConfigLookup(value)
+        self.generation += 1
+
+    @property
+    def modules(self) -> Dict[str, Any]:
+        return self.modules_lookup.data
+
+    @modules.setter
+    def modules(self, value: Dict[str, Any]) -> None:
+        self.modules_lookup = ConfigLookup(value)
+        self.generation += 1
+
+    @property
+    def servers(self) -> Dict[str, Any]:
+        return self.servers_lookup.data
+
+    @servers.setter
+    def servers(self, value: Dict[str, Any]) -> None:
+        self.servers_lookup = ConfigLookup(value)
+        self.servers_by_id = index_servers(value)
+        self.generation += 1
 
     def get_main(self, key: str, default: Optional[T] = None) -> T:
         """
         Get a config for the *main* config file. That is `main.toml`.
         """
-        out = cast(Optional[T], get_nested_dict_value(self.main, key))
+        out = cast(Optional[T], self.main_lookup.get(key))
         if out is not None:
             return out
 
@@ -32,7 +67,7 @@ class ConfigManager(object):
         return default
 
     def get_module(self, key: str, default: Optional[T] = None) -> T:
-        out = cast(Optional[T], get_nested_dict_value(self.modules, key))
+        out = cast(Optional[T], self.modules_lookup.get(key))
         if out is not None:
             return out
 
@@ -42,31 +77,127 @@ class ConfigManager(object):
         return default
 
     async def load_from(self, path: Path) -> None:
-        self.path = path
-        await asyncio.gather(
-            self.load_main(path),
-            self.load_servers(path),
-            self.load_modules(path)
+        """
+        Loads the config files in path.
+        Raises ConfigError if they're broken, in which case the config we had stays.
+        """
+        main, servers, modules = await self.read(path)
+        self.swap(path, main, servers, modules)
+
+    async def read(self, path: Path) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+        """
+        Reads and validates the main, servers and modules config files in path, without using them yet.
+        """
+        main, servers, modules = await asyncio.gather(
+            read_config_file(path.joinpath("main.toml")),
+            read_config_file(path.joinpath("servers.toml")),
+            read_config_file(path.joinpath("modules.toml"))
         )
+        validate_config(main, servers)
+        return main, servers, modules
+
+    def swap(self, path: Path, main: Dict[str, Any], servers: Dict[str, Any], modules: Dict[str, Any]) -> None:
+        # All at once, so nothing sees half of a reload.
+        self.path = path
+        self.main = main
+        self.servers = servers
+        self.modules = modules
 
-    async def load_main(self, path: Path) -> None:
-        async with aiofiles.open(path.joinpath("main.toml"), "r") as f:
-            self.main = dict(toml.loads(await f.read()))
+    def mtimes(self) -> Tuple[float, ...]:
+        """
+        Modification times of the config files, to see whether they changed.
+        """
+        if self.path is None:
+            return ()
 
-    async def load_servers(self, path: Path) -> None:
-        async with aiofiles.open(path.joinpath("servers.toml"), "r") as f:
-            self.servers = dict(toml.loads(await f.read()))
+        return tuple(self.path.joinpath(name).stat().st_mtime for name in CONFIG_FILES)
 
-    async def load_modules(self, path: Path) -> None:
-        async with aiofiles.open(path.joinpath("modules.toml"), "r") as f:
-            self.modules = dict(toml.loads(await f.read()))
 
+CONFIG_FILES = ("main.toml", "servers.toml", "modules.toml")
 
-def get_nested_dict_value(dictionary: Dict[str, Any], key: str) -> Any:
-    tree = key.split(".")
 
+async def read_config_file(path: Path) -> Dict[str, Any]:
+    async with aiofiles.open(path, "r") as f:
+        try:
+            return dict(toml.loads(await f.read()))
+
+        except toml.TomlDecodeError as e:
+            raise ConfigError(f"{path.name}: {e}")
+
+
+def index_servers(servers: Dict[str, Any]) -> Dict[int, Dict[str, Any]]:
+    """
+    Maps guild IDs to their config, out of the contents of a servers.toml.
+    """
+    return {int(server["id"]): server for server in servers.get("servers", [])}
+
+
+def is_snowflake(value: Any) -> bool:
+    return isinstance(value, int) or (isinstance(value, str) and value.isdigit())
+
+
+def validate_config(main: Dict[str, Any], servers: Dict[str, Any]) -> None:
+    """
+    Checks the parts of the config MoMMI itself relies on, raising ConfigError on the first problem.
+    Module config is up to the modules.
+    """
+    from MoMMI.role import MRoleType
+
+    if not is_snowflake(get_nested_dict_value(main, "bot.owner")):
+        raise ConfigError("main.toml: bot.owner must be a user ID.")
+
+    routes = get_nested_dict_value(main, "commloop.route")
+    if routes is not None and (not isinstance(routes, dict) or
+                               not all(isinstance(route, dict) for route in routes.values())):
+        raise ConfigError("main.toml: commloop.route must be a table of tables.")
+
+    serverlist = servers.get("servers", [])
+    if not isinstance(serverlist, list):
+        raise ConfigError("servers.toml: servers must be an array of tables.")
+
+    ids: Set[int] = set()
+    names: Set[str] = set()
+    for server in serverlist:
+        if not isinstance(server, dict) or not is_snowflake(server.get("id")) or not isinstance(server.get("name"), str):
+            raise ConfigError("servers.toml: every server needs an ID and a name.")
+
+        name = server["name"]
+        if int(server["id"]) in ids or name in names:
+            raise ConfigError(f"servers.toml: server {name} ({server['id']}) is in there twice.")
+
+        ids.add(int(server["id"]))
+        names.add(name)
+
+        for rolename, snowflakes in server.get("roles", {}).items():
+            if rolename not in MRoleType.__members__:
+                raise ConfigError(f"servers.toml: {name} has unknown role {rolename}.")
+
+            if not isinstance(snowflakes, list):
+                snowflakes = [snowflakes]
+
+            if not all(map(is_snowflake, snowflakes)):
+                raise ConfigError(f"servers.toml: role {rolename} of {name} must be role IDs.")
+
+        for channelname, snowflake in server.get("channels", {}).items():
+            if not is_snowflake(snowflake):
+                raise ConfigError(f"servers.toml: channel {channelname} of {name} must be a channel ID.")
+
+
+# Dotted keys, split. Keys are nearly always literals in the code, so this stays small.
+key_paths: Dict[str, Tuple[str, ...]] = {}
+
+
+def split_key(key: str) -> Tuple[str, ...]:
+    path = key_paths.get(key)
+    if path is None:
+        path = key_paths[key] = tuple(key.split("."))
+
+    return path
+
+
+def get_nested_dict_value(dictionary: Dict[str, Any], key: str) -> Any:
     current = dictionary
-    for node in tree:
+    for node in split_key(key):
         if isinstance(current, dict):
             if node in current:
                 current = current[node]
@@ -78,6 +209,26 @@ def get_nested_dict_value(dictionary: Dict[str, Any], key: str) -> Any:
     return current
 
 
+class ConfigLookup(object):
+    """
+    Memoised get_nested_dict_value() on one config dict.
+    The config must not be modified in place once it's looked up in, replace the lookup along with it instead.
+    """
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self.data = data
+        # Missing keys are cached too, as None.
+        self.cache: Dict[str, Any] = {}
+
+    def get(self, key: str) -> Any:
+        try:
+            return self.cache[key]
+
+        except KeyError:
+            value = self.cache[key] = get_nested_dict_value(self.data, key)
+            return value
+
+
 class ConfigError(Exception):
     """
     An exception caused by broken configuration files.
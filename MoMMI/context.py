@@ -0,0 +1,122 @@
+from typing import Any, Callable, Dict, Generic, List, Match, Optional, Pattern, Set, TypeVar, TYPE_CHECKING, cast
+from discord import Message
+from MoMMI.commands import MCommand, RELAYED_MARKER
+from MoMMI.types import SnowflakeID
+
+if TYPE_CHECKING:
+    from MoMMI.channel import MChannel
+
+T = TypeVar("T")
+
+IRC_MARKER = RELAYED_MARKER + "**IRC:**"
+
+
+class lazy_property(Generic[T]):
+    """
+    Like property, but the getter only runs once, after which the result is stored on the instance.
+    """
+
+    def __init__(self, func: Callable[[Any], T]) -> None:
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance: Any, owner: Any) -> T:
+        if instance is None:
+            return cast(T, self)
+
+        value = self.func(instance)
+        instance.__dict__[self.name] = value
+        return value
+
+
+class MMessageContext(object):
+    """
+    Facts about an incoming message that multiple handlers need.
+    Built once per message in on_message and handed to the router and handlers,
+    every fact is only computed once, when first needed.
+    """
+
+    def __init__(self, channel: "MChannel", message: Message) -> None:
+        self.channel: "MChannel" = channel
+        self.message: Message = message
+        self.content: str = message.content
+        self.regex_cache: Dict[Pattern, List[Match]] = {}
+
+    @lazy_property
+    def prefix_match(self) -> Optional[Match]:
+        """
+        The match of the mention prefix (@MoMMI), None if the message doesn't start with it.
+        """
+        if MCommand.prefix_re is None:
+            raise RuntimeError("MCommand.prefix_re has not been set!")
+
+        return MCommand.prefix_re.match(self.content)
+
+    @lazy_property
+    def command_body(self) -> Optional[str]:
+        """
+        The message with the mention prefix stripped off, None if the message doesn't start with it.
+        """
+        match = self.prefix_match
+        if match is None:
+            return None
+
+        return self.content[match.end():]
+
+    @lazy_property
+    def lowered(self) -> str:
+        return self.content.lower()
+
+    @lazy_property
+    def author_roles(self) -> Set[SnowflakeID]:
+        return {SnowflakeID(role.id) for role in getattr(self.message.author, "roles", [])}
+
+    @lazy_property
+    def from_self(self) -> bool:
+        return bool(self.message.author.id == self.channel.server.master.client.user.id)
+
+    @lazy_property
+    def from_bot(self) -> bool:
+        return bool(self.message.author.bot)
+
+    @lazy_property
+    def relayed(self) -> bool:
+        """
+        Whether this message was relayed by MoMMI from somewhere else, like IRC.
+        """
+        return self.content.startswith(RELAYED_MARKER)
+
+    @lazy_property
+    def irc_echo(self) -> bool:
+        """
+        Whether this is a message we relayed from IRC ourselves.
+        """
+        return self.from_self and self.content.startswith(IRC_MARKER)
+
+    @lazy_property
+    def attachments(self) -> List[str]:
+        """
+        URLs of the attachments of the message.
+        """
+        return [attachment["url"] for attachment in self.message.attachments]
+
+    @lazy_property
+    def content_with_attachments(self) -> str:
+        """
+        The message content with the attachment URLs tacked onto the end.
+        """
+        if not self.attachments:
+            return self.content
+
+        return " ".join([self.content, *self.attachments])
+
+    def find_all(self, regex: Pattern) -> List[Match]:
+        """
+        All matches of regex in the message content, cached per regex.
+        """
+        matches = self.regex_cache.get(regex)
+        if matches is None:
+            matches = self.regex_cache[regex] = list(regex.finditer(self.content))
+
+        return matches
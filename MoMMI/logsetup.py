@@ -1,11 +1,29 @@
 # Handles setup of the loggers.
 
+import atexit
+import copy
+import gzip
 import logging
 import logging.handlers
+import os
+import queue
 import re
-import copy
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import cast, Type
+from typing import cast, Type, Any, IO, List, Optional
+
+# Log files get rotated once they're this big or this old.
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+# Seconds between flushes of the log files when nothing is being logged.
+FLUSH_INTERVAL = 1.0
+# Maximum amount of records written between flushes.
+BATCH_SIZE = 1000
+# Put on the writer queue to stop the writer.
+STOP = object()
 
 COLOR_ESCAPE = re.compile(r"\$(BLACK|RED|GREEN|YELLOW|BLUE|MAGENTA|CYAN|WHITE|BOLD|RESET)")
 
@@ -58,7 +76,186 @@ try:
 except ImportError:
     ColorFormatter = NotColorFormatter
 
-def setup_logs() -> None:
+class ChatFormatter(logging.Formatter):
+    """
+    Prefixes chat messages with an ISO 8601 UTC timestamp of when they were logged.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = datetime.fromtimestamp(record.created, timezone.utc).isoformat()
+        return f"[{timestamp}]{record.getMessage()}"
+
+
+class MRotatingFile(object):
+    """
+    A log file that gets rotated once it's too big or too old.
+    Rotated files get a timestamp suffix and are optionally gzipped.
+    Written as UTF-8 bytes, so the size max_bytes is checked against is the size on disk.
+    Only ever touched from the log writer thread.
+    """
+
+    def __init__(self, path: Path, max_bytes: int, max_age: float, compress: bool) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+        self.file: Optional[IO[bytes]] = None
+        self.size = 0
+        self.opened = 0.0
+        self.dirty = False
+
+    def open(self) -> IO[bytes]:
+        if self.file is None:
+            self.file = open(self.path, "ab")
+            self.size = self.file.tell()
+            self.opened = time.time()
+            if self.size:
+                # Don't rotate an old file right away just because we restarted, but don't keep it forever either.
+                self.opened = min(self.opened, os.path.getmtime(self.path))
+
+        return self.file
+
+    def write(self, data: str) -> None:
+        f = self.open()
+        encoded = data.encode("utf-8")
+        f.write(encoded)
+        self.size += len(encoded)
+        self.dirty = True
+        if self.max_bytes and self.size >= self.max_bytes:
+            self.rotate()
+
+    def flush(self) -> None:
+        if self.file is not None and self.dirty:
+            self.file.flush()
+            self.dirty = False
+
+    def check_age(self) -> None:
+        if self.file is not None and self.size and self.max_age and time.time() - self.opened >= self.max_age:
+            self.rotate()
+
+    def rotate(self) -> None:
+        self.close()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+        target = self.path.with_name(f"{self.path.name}.{stamp}")
+        offset = 0
+        while target.exists() or target.with_name(target.name + ".gz").exists():
+            offset += 1
+            target = self.path.with_name(f"{self.path.name}.{stamp}-{offset}")
+
+        os.replace(str(self.path), str(target))
+        if self.compress:
+            with open(target, "rb") as source, gzip.open(str(target) + ".gz", "wb") as dest:
+                shutil.copyfileobj(source, dest)
+
+            os.remove(target)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.dirty = False
+
+
+class MQueuedFileHandler(logging.Handler):
+    """
+    Hands records off to the log writer thread instead of writing them itself.
+
+    Records are formatted right away like logging.handlers.QueueHandler.prepare() does,
+    so the writer never sees arguments that changed after the logging call,
+    and queued records don't keep tracebacks and everything in their frames alive.
+    """
+
+    def __init__(self, writer: "MLogWriter", file: MRotatingFile) -> None:
+        super().__init__()
+        self.writer = writer
+        self.file = file
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            message = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        record = copy.copy(record)
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        self.writer.queue.put_nowait((self, record))
+
+    def write_record(self, record: logging.LogRecord) -> None:
+        try:
+            self.file.write(record.msg + "\n")
+        except Exception:
+            self.handleError(record)
+
+
+class MLogWriter(threading.Thread):
+    """
+    Background thread that writes log records to disk in batches,
+    so disk latency never stalls the event loop.
+    """
+
+    def __init__(self, flush_interval: float) -> None:
+        super().__init__(name="MoMMI log writer", daemon=True)
+        self.queue: "queue.Queue[Any]" = queue.Queue()
+        self.flush_interval = flush_interval
+        self.files: List[MRotatingFile] = []
+
+    def run(self) -> None:
+        running = True
+        while running:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+
+            batch = []
+            if item is not None:
+                batch.append(item)
+
+            # Drain whatever else is queued up, so it all goes out in one go.
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for entry in batch:
+                if entry is STOP:
+                    running = False
+                    continue
+
+                handler, record = entry
+                handler.write_record(record)
+
+            for file in self.files:
+                file.flush()
+                file.check_age()
+
+        for file in self.files:
+            file.close()
+
+    def add_file(self, path: Path, level: int, formatter: logging.Formatter, max_bytes: int, max_age: float, compress: bool) -> logging.Handler:
+        file = MRotatingFile(path, max_bytes, max_age, compress)
+        self.files.append(file)
+        handler = MQueuedFileHandler(self, file)
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+        return handler
+
+    def stop(self) -> None:
+        """
+        Writes out everything still queued and stops the thread.
+        """
+        self.queue.put(STOP)
+        self.join(5)
+
+
+def setup_logs(file_level: int = logging.DEBUG,
+               max_bytes: int = DEFAULT_MAX_BYTES,
+               max_age: float = DEFAULT_MAX_AGE,
+               compress: bool = True) -> None:
     outdir = Path("logs")
     if not outdir.is_dir():
         outdir.mkdir(parents=True)
@@ -75,34 +272,25 @@ def setup_logs() -> None:
     handler.setFormatter(colorformatter)
     logger.addHandler(handler)
 
-    # FileHandler to log EVERYTHING.
-    path = outdir/"all.log"
-    open(path, "a").close()
+    # All log files get written from a background thread.
+    writer = MLogWriter(FLUSH_INTERVAL)
 
-    handler = logging.FileHandler(str(path))
-    handler.setLevel(logging.DEBUG)
-    handler.setFormatter(formatter)
+    # Log EVERYTHING, or at least everything at file_level.
+    handler = writer.add_file(outdir/"all.log", file_level, formatter, max_bytes, max_age, compress)
     logger.addHandler(handler)
 
-    # FileHandler to log errors.
-    path = outdir/"error.log"
-    open(path, "a").close()
-
-    handler = logging.FileHandler(str(path))
-    handler.setLevel(logging.ERROR)
-    handler.setFormatter(formatter)
+    # Log errors.
+    handler = writer.add_file(outdir/"error.log", logging.ERROR, formatter, max_bytes, max_age, compress)
     logger.addHandler(handler)
 
-    path = outdir/"chat.log"
-    open(path, "a").close()
-
-    handler = logging.FileHandler(str(path))
-    handler.setLevel(logging.INFO)
-    handler.setFormatter(logging.Formatter())
+    handler = writer.add_file(outdir/"chat.log", logging.INFO, ChatFormatter(), max_bytes, max_age, compress)
     chatlogger = logging.getLogger("chat")
     chatlogger.propagate = False
     chatlogger.addHandler(handler)
 
+    writer.start()
+    atexit.register(writer.stop)
+
     logging.getLogger("websockets").setLevel(logging.WARNING)
     logging.getLogger("urllib3").setLevel(logging.WARNING)
     logging.getLogger("bottom").setLevel(logging.WARNING)
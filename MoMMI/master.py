@@ -3,16 +3,17 @@ import asyncio
 import importlib
 import logging
 import os
-import pickle
 import re
 import signal
 import sys
+from functools import partial
 from pathlib import Path
 from typing import List, Dict, Any, Optional, Iterable, TYPE_CHECKING, Union, Type, TypeVar
-import aiofiles
 import discord
 from MoMMI.config import ConfigManager
-from MoMMI.module import MModule
+from MoMMI.metrics import MMetrics
+from MoMMI.module import MModule, collect_handlers
+from MoMMI.storage import MStorage, open_backend
 from MoMMI.types import SnowflakeID
 
 LOGGER: logging.Logger = logging.getLogger("master")
@@ -35,6 +36,8 @@ class MoMMI(object):
         from MoMMI.commloop import commloop
         from MoMMI.handler import MHandler
         from MoMMI.server import MServer
+        from MoMMI.router import MCommandRouter
+        from MoMMI.scheduler import MDispatchScheduler
 
         self.config = ConfigManager()
         self.modules: Dict[str, MModule] = {}
@@ -53,9 +56,20 @@ class MoMMI(object):
         self.shutting_down = False
         self.client = discord.Client()
         self.commloop: Optional[commloop] = None
+        self.scheduler: Optional[MDispatchScheduler] = None
+        self.metrics = MMetrics()
+        self.metrics.add_source("storage", self.storage_report)
+        self.metrics_task: Optional[asyncio.Future] = None
+        self.config_watch_task: Optional[asyncio.Future] = None
         self.storagedir: Optional[Path] = None
         self.global_storagedir: Optional[Path] = None
-        self.global_storage: Dict[str, Any] = {}
+        self.global_storage = MStorage()
+        # Limits concurrent storage I/O, created by the first storage opened.
+        self.storage_io: Optional[asyncio.Semaphore] = None
+        # Handlers of all modules by type, see get_global_handlers.
+        self.handler_index: Dict[type, List[Any]] = {}
+        # Rebuilt after every module reload.
+        self.command_router = MCommandRouter(self)
 
         # Find all on_xxx attributes and register them to the client.
         for member in dir(self):
@@ -87,6 +101,7 @@ class MoMMI(object):
     async def on_ready(self) -> None:
         from MoMMI.commloop import commloop
         from MoMMI.commands import MCommand
+        from MoMMI.scheduler import MDispatchScheduler
         if self.initialized:
             LOGGER.debug("on_ready called again, ignoring.")
             return
@@ -97,17 +112,29 @@ class MoMMI(object):
         self.commloop = commloop(self, self.client.loop)
         await self.commloop.start()
 
+        self.scheduler = MDispatchScheduler(self, self.client.loop)
+
+        if self.storagedir is not None:
+            interval = self.config.get_main("metrics.dump_interval", 300)
+            self.metrics_task = asyncio.ensure_future(
+                self.metrics.dump_loop(self.storagedir/"__metrics__", interval), loop=self.client.loop)
+
+        watch_interval = self.config.get_main("config.watch_interval", 0)
+        if watch_interval > 0:
+            self.config_watch_task = asyncio.ensure_future(self.watch_config(watch_interval), loop=self.client.loop)
+
         LOGGER.info(
             f"$BLUELogged in as $WHITE{self.client.user.name}$RESET ($YELLOW{self.client.user.id}$RESET)")
 
         MCommand.prefix_re = re.compile(rf"^<@\!?{self.client.user.id}>\s*")
 
+        # Before the modules, so they can see what's stored when they load.
+        await self.load_all_global_storages()
+        LOGGER.info("Opened global storages.")
+
         await self.reload_modules()
         LOGGER.info(f"$BLUELoaded $WHITE{len(self.modules)}$BLUE modules.")
 
-        await self.load_all_global_storages()
-        LOGGER.info("Loaded global storages.")
-
         tasks = []
         LOGGER.info("$BLUEConnected servers:")
         for server in self.client.servers:
@@ -250,6 +277,8 @@ class MoMMI(object):
                 errors = True
 
         self.temp_module_handlers = []
+        self.invalidate_handlers()
+        self.command_router.build()
 
         return errors
 
@@ -263,31 +292,49 @@ class MoMMI(object):
 
         module = self.get_module(handler.module)
         module.handlers[handler.name] = handler
+        self.invalidate_handlers()
 
-    async def on_message(self, message: discord.Message) -> None:
-        from MoMMI.commands import MCommand
-        from MoMMI.util import utcnow
-        if not self.initialized or self.shutting_down:
-            return
+    def invalidate_handlers(self) -> None:
+        """
+        Drops all the cached handler lists, they get rebuilt when next needed.
+        """
+        self.handler_index = {}
+        for server in self.servers.values():
+            server.handler_index = {}
 
-        # Ignore IRC messages.
-        if message.author.id == self.client.user.id and message.content.startswith("\u200B**IRC:**"):
+        self.command_router.invalidate()
+        self.invalidate_comm_routes()
+
+    def invalidate_comm_routes(self) -> None:
+        """
+        Makes the commloop rebuild its routing table, for when handlers, servers or channels change.
+        """
+        if self.commloop is not None:
+            self.commloop.invalidate()
+
+    async def on_message(self, message: discord.Message) -> None:
+        from MoMMI.context import MMessageContext
+        if not self.initialized or self.shutting_down or self.scheduler is None:
             return
 
         server = self.get_server(SnowflakeID(message.server.id))
         channel = server.get_channel(SnowflakeID(message.channel.id))
+        context = MMessageContext(channel, message)
 
-        logmsg = f"[{utcnow().isoformat()}]({server.name}/{message.channel.name}) {message.author.name}#{message.author.discriminator}: {message.content}"
+        # Ignore IRC messages.
+        if context.irc_echo:
+            return
 
-        if message.attachments:
-            logmsg += "[Attachments]"
-            for attach in message.attachments:
-                logmsg += " " + attach["url"]
+        # Formatting and the timestamp are taken care of by the log writer, off the event loop.
+        attachments = ""
+        if context.attachments:
+            attachments = "[Attachments] " + " ".join(context.attachments)
 
-        CHAT_LOGGER.info(logmsg)
+        CHAT_LOGGER.info("(%s/%s) %s#%s: %s%s", server.name, message.channel.name,
+                         message.author.name, message.author.discriminator, message.content, attachments)
 
-        for command in channel.iter_handlers(MCommand):
-            await command.try_execute(channel, message)
+        for command, match in self.command_router.route(context):
+            self.scheduler.submit(channel, partial(command.execute, channel, message, match, context))
 
     def get_server(self, serverid: Union[SnowflakeID, str]) -> "MServer":
         if isinstance(serverid, str):
@@ -304,23 +351,22 @@ class MoMMI(object):
 
     async def add_server(self, server: discord.Server) -> None:
         from MoMMI.server import MServer
-        if self.storagedir is None:
-            raise RuntimeError("No storage dir specified!")
-
         LOGGER.debug(f"Adding server {server.name}.")
         new = self.servers[SnowflakeID(server.id)] = MServer(server, self)
         new.modules = self.modules.copy()
+        await self.configure_server(new)
 
-        # TODO: Figure out a better way for this.
-        cfg = None
-        for serverconfig in self.config.servers["servers"]:
-            if SnowflakeID(serverconfig["id"]) == int(new.id):
-                cfg = serverconfig
-                break
+    async def configure_server(self, new: "MServer") -> None:
+        """
+        Applies the config of a server MoMMI is in and opens its storage.
+        """
+        if self.storagedir is None:
+            raise RuntimeError("No storage dir specified!")
 
+        cfg = self.config.servers_by_id.get(int(new.id))
         if not cfg:
             LOGGER.error(
-                f"No configuration present for server {server.name} ({server.id})!")
+                f"No configuration present for server {new.visible_name} ({new.id})!")
             return
 
         new.load_server_config(cfg)
@@ -330,6 +376,8 @@ class MoMMI(object):
         else:
             self.servers_name[new.name] = new
 
+        self.invalidate_comm_routes()
+
         data_path: Path = self.storagedir.joinpath(new.name)
         if not data_path.exists():
             LOGGER.debug(
@@ -340,6 +388,78 @@ class MoMMI(object):
                 f"Data storage directory for {new.name} exists but is not a file!")
         await new.load_data_storages(data_path)
 
+    async def reload_config(self) -> None:
+        """
+        Reloads the config files and updates everything derived from them: server roles, channel names and commloop routing.
+        Raises ConfigError if the new config is broken, in which case nothing changes.
+        Bot, commloop address and storage settings only apply after a restart.
+        """
+        from MoMMI.config import ConfigError, index_servers
+        if self.config.path is None:
+            raise RuntimeError("Config was never loaded, can't reload it.")
+
+        main, servers, modules = await self.config.read(self.config.path)
+        new_configs = index_servers(servers)
+        for server in self.servers.values():
+            cfg = new_configs.get(int(server.id))
+            # Storage is kept in a directory named after the server.
+            if server.name and cfg is not None and cfg["name"] != server.name:
+                raise ConfigError(f"Server {server.name} can't be renamed to {cfg['name']} without a restart.")
+
+        # No awaits from here until everything's updated, so nothing sees a mix of old and new.
+        self.config.swap(self.config.path, main, servers, modules)
+        unconfigured = []
+        for server in self.servers.values():
+            cfg = self.config.servers_by_id.get(int(server.id))
+            if cfg is None:
+                if server.name:
+                    LOGGER.warning(f"Server {server.name} was removed from the config, keeping its old config until restart.")
+
+            elif not server.name:
+                unconfigured.append(server)
+
+            else:
+                server.load_server_config(cfg)
+
+        self.command_router.invalidate_filters()
+        if self.commloop is not None:
+            self.commloop.load_config()
+
+        # Servers that weren't configured before get set up in place, keeping their channels and queues.
+        for server in unconfigured:
+            await self.configure_server(server)
+
+    async def watch_config(self, interval: float) -> None:
+        """
+        Reloads the config whenever one of the files changes.
+        """
+        from MoMMI.config import ConfigError
+        mtimes = self.config.mtimes()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                current = self.config.mtimes()
+
+            except OSError:
+                # Probably being replaced by an editor right now, check again next time.
+                continue
+
+            if current == mtimes:
+                continue
+
+            mtimes = current
+            try:
+                await self.reload_config()
+
+            except ConfigError as e:
+                LOGGER.error(f"$REDNot reloading changed config files: {e}")
+
+            except:
+                LOGGER.exception("$REDFailed to reload changed config files.")
+
+            else:
+                LOGGER.info("$GREENReloaded changed config files.")
+
     async def on_server_remove(self, server: discord.Server) -> None:
         LOGGER.info(f"Left server {server.name}.")
         await self.remove_server(server)
@@ -353,6 +473,7 @@ class MoMMI(object):
         mserver = self.get_server(SnowflakeID(server.id))
         del self.servers_name[mserver.name]
         del self.servers[mserver.id]
+        self.invalidate_comm_routes()
 
     async def shutdown(self) -> None:
         LOGGER.info("$REDShutting down!")
@@ -361,6 +482,10 @@ class MoMMI(object):
             LOGGER.debug("Closing commloop.")
             await self.commloop.stop()
 
+        if self.scheduler:
+            LOGGER.debug("Waiting for running commands.")
+            await self.scheduler.drain(5)
+
         async def try_unload_module(module: MModule) -> None:
             try:
                 if hasattr(module.module, "unload"):
@@ -382,6 +507,19 @@ class MoMMI(object):
         await asyncio.gather(*tasks)
 
         await self.save_all_storage()
+        await asyncio.gather(self.global_storage.close(), *(server.storage.close() for server in self.servers.values()))
+
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+
+        if self.config_watch_task is not None:
+            self.config_watch_task.cancel()
+
+        if self.storagedir is not None:
+            try:
+                await self.metrics.dump(self.storagedir/"__metrics__")
+            except:
+                LOGGER.exception("Failed to dump metrics for shutdown.")
 
         LOGGER.info("Goodbye.")
 
@@ -436,65 +574,90 @@ class MoMMI(object):
         return key in self.cache
 
     def iter_global_handlers(self, handlertype: Type[T]) -> Iterable[T]:
-        for module in self.modules.values():
-            yield from (x for x in module.handlers.values() if isinstance(x, handlertype))
+        return self.get_global_handlers(handlertype)
+
+    def get_global_handlers(self, handlertype: Type[T]) -> List[T]:
+        """
+        Get all handlers of a type, across all modules.
+        The list is cached until handlers change, so don't modify it.
+        """
+        handlers: Optional[List[T]] = self.handler_index.get(handlertype)
+        if handlers is None:
+            handlers = self.handler_index[handlertype] = collect_handlers(self.modules.values(), handlertype)
+
+        return handlers
+
+    def storage_report(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """
+        MStorage.report() of the global storage and every server, by server name.
+        """
+        report = {"__global__": self.global_storage.report()}
+        for server in self.servers.values():
+            report[server.name] = server.storage.report()
+
+        return report
 
     async def save_all_storage(self) -> None:
         """
         Save all storages, including server and global storages.
+        They're all saved at once, the amount of writes actually running at a time is limited by `storage.io_parallelism`.
         """
-        await asyncio.gather(*(server.save_all_storages() for server in self.servers.values()))
-        await self.save_all_global_storages()
+        await asyncio.gather(self.save_all_global_storages(), *(server.save_all_storages() for server in self.servers.values()))
 
     def get_global_storage(self, name: str) -> Any:
         """
         Fetch a GLOBAL storage.
         """
-        return self.global_storage[name]
+        return self.global_storage.get(name)
 
     def set_global_storage(self, name: str, value: Any) -> None:
         """
         Set a GLOBAL storage.
         """
-        self.global_storage[name] = value
+        self.global_storage.set(name, value)
+
+    async def load_global_storage(self, name: str) -> None:
+        """
+        Makes sure a GLOBAL storage is loaded without blocking, so get_global_storage() doesn't have to load it on the loop.
+        """
+        await self.global_storage.load(name)
 
     def has_global_storage(self, name: str) -> bool:
         """
         Check whether a GLOBAL storage exists or not.
         """
-        return name in self.global_storage
+        return self.global_storage.has(name)
+
+    def mark_global_storage_dirty(self, name: str) -> None:
+        """
+        Marks a GLOBAL storage as changed so it gets saved, for storages modified in place.
+        """
+        self.global_storage.mark_dirty(name)
 
     async def save_global_storage(self, name: str) -> None:
         if self.global_storagedir is None:
             raise RuntimeError("Storage dir has not been set. Cannot save storages!")
 
-        storage = self.get_global_storage(name)
-        data = pickle.dumps(storage)
-        async with aiofiles.open(self.global_storagedir/name, "wb") as f:
-            await f.write(data)
+        await self.global_storage.save(name)
+
+    def schedule_global_storage_save(self, name: str) -> None:
+        """
+        Saves a GLOBAL storage some time soon, together with other storages changed around the same time.
+        """
+        self.global_storage.schedule_save(name)
 
     async def save_all_global_storages(self) -> None:
-        for name in self.global_storage.keys():
-            await self.save_global_storage(name)
+        """
+        Saves every GLOBAL storage that changed since it was last saved.
+        """
+        await self.global_storage.save_dirty()
 
     async def load_all_global_storages(self) -> None:
         if self.global_storagedir is None:
             raise RuntimeError("Storage dir has not been set. Cannot save storages!")
 
-        await asyncio.gather(
-            *(self.load_single_global_storage(m.name, m) for m in self.global_storagedir.iterdir())
-        )
-
-    async def load_single_global_storage(self, module: str, file: Path) -> None:
-        data: Any
-        try:
-            async with aiofiles.open(file, "rb") as f:
-                data = pickle.loads(await f.read())
-
-            self.global_storage[module] = data
-
-        except:
-            LOGGER.exception(f"Failed to load global storage {module}")
+        await self.global_storage.open(open_backend(self, self.global_storagedir), self)
+        self.global_storage.start_prefetch()
 
 
 master = MoMMI()
@@ -0,0 +1,187 @@
+import asyncio
+import json
+import logging
+import time
+from bisect import bisect_left
+from pathlib import Path
+from typing import Callable, Dict, List, Any, Optional, Tuple, TYPE_CHECKING
+import aiofiles
+
+if TYPE_CHECKING:
+    from MoMMI.handler import MHandler
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in milliseconds.
+# Anything above the last one goes into an overflow bucket.
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class MHistogram(object):
+    """
+    Fixed bucket latency histogram. Cheap to record into, percentiles are approximate.
+    """
+
+    def __init__(self) -> None:
+        self.counts: List[int] = [0] * (len(BUCKETS_MS) + 1)
+        self.count: int = 0
+        self.total_ms: float = 0
+        self.max_ms: float = 0
+
+    def observe(self, milliseconds: float) -> None:
+        self.counts[bisect_left(BUCKETS_MS, milliseconds)] += 1
+        self.count += 1
+        self.total_ms += milliseconds
+        if milliseconds > self.max_ms:
+            self.max_ms = milliseconds
+
+    def percentile(self, percent: float) -> float:
+        """
+        Returns the upper bound of the bucket the percentile falls in.
+        The overflow bucket reports the maximum instead.
+        """
+        if not self.count:
+            return 0
+
+        target = self.count * percent / 100
+        seen = 0
+        for index, amount in enumerate(self.counts):
+            seen += amount
+            if seen >= target:
+                if index >= len(BUCKETS_MS):
+                    return self.max_ms
+
+                return min(BUCKETS_MS[index], self.max_ms)
+
+        return self.max_ms
+
+    @property
+    def mean_ms(self) -> float:
+        if not self.count:
+            return 0
+
+        return self.total_ms / self.count
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.percentile(50),
+            "p99_ms": self.percentile(99),
+            "buckets": dict(zip([str(x) for x in BUCKETS_MS] + ["inf"], self.counts)),
+        }
+
+
+class MHandlerStats(object):
+    def __init__(self) -> None:
+        self.calls: int = 0
+        self.errors: int = 0
+        self.latency = MHistogram()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "latency": self.latency.to_dict(),
+        }
+
+
+class MMetrics(object):
+    """
+    Call counts, error counts and latencies of handlers, keyed by module/name.
+    Also holds miscellaneous named histograms and counters,
+    and sources: functions whose output gets included in snapshots.
+    Lives on the master so it survives module reloads.
+    """
+
+    def __init__(self) -> None:
+        self.started: float = time.time()
+        self.handlers: Dict[str, MHandlerStats] = {}
+        self.histograms: Dict[str, MHistogram] = {}
+        self.counters: Dict[str, int] = {}
+        self.sources: Dict[str, Callable[[], Any]] = {}
+
+    def get_histogram(self, name: str) -> MHistogram:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = MHistogram()
+
+        return histogram
+
+    def observe(self, name: str, milliseconds: float) -> None:
+        self.get_histogram(name).observe(milliseconds)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_source(self, name: str, source: Callable[[], Any]) -> None:
+        """
+        Includes the (JSON serializable) return value of source under name in every snapshot.
+        """
+        self.sources[name] = source
+
+    def get_handler_stats(self, key: str) -> MHandlerStats:
+        stats = self.handlers.get(key)
+        if stats is None:
+            stats = self.handlers[key] = MHandlerStats()
+
+        return stats
+
+    def record_handler(self, handler: "MHandler", seconds: float, error: bool) -> None:
+        stats = self.get_handler_stats(f"{handler.module}/{handler.name}")
+        stats.calls += 1
+        if error:
+            stats.errors += 1
+
+        stats.latency.observe(seconds * 1000)
+
+    def top_handlers(self, sort: str = "total", amount: int = 10) -> List[Tuple[str, MHandlerStats]]:
+        """
+        Get the worst handlers. Sort can be total, p99, max, calls or errors.
+        """
+        keys = {
+            "total": lambda x: x[1].latency.total_ms,
+            "p99": lambda x: x[1].latency.percentile(99),
+            "max": lambda x: x[1].latency.max_ms,
+            "calls": lambda x: x[1].calls,
+            "errors": lambda x: x[1].errors,
+        }
+
+        return sorted(self.handlers.items(), key=keys[sort], reverse=True)[:amount]
+
+    def snapshot(self) -> Dict[str, Any]:
+        snapshot = {
+            "started": self.started,
+            "time": time.time(),
+            "handlers": {key: stats.to_dict() for key, stats in self.handlers.items()},
+            "histograms": {key: histogram.to_dict() for key, histogram in self.histograms.items()},
+            "counters": dict(self.counters),
+        }
+
+        for name, source in self.sources.items():
+            try:
+                snapshot[name] = source()
+            except:
+                logger.exception(f"Exception in metrics source {name}.")
+
+        return snapshot
+
+    async def dump(self, directory: Path) -> None:
+        """
+        Writes a snapshot to a JSON file in directory.
+        There's one file per process start, so runs can be compared between deploys.
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory/f"metrics-{int(self.started)}.json"
+        data = json.dumps(self.snapshot(), indent=1)
+        async with aiofiles.open(path, "w") as f:
+            await f.write(data)
+
+    async def dump_loop(self, directory: Path, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.dump(directory)
+            except:
+                logger.exception("Failed to dump metrics.")
@@ -1,4 +1,6 @@
-from typing import Dict, Any
+from typing import Dict, Any, Iterable, List, Type, TypeVar
+
+T = TypeVar("T")
 
 class MModule(object):
     def __init__(self, name: str) -> None:
@@ -9,3 +11,15 @@ class MModule(object):
         self.loaded: bool = False
         # The actual module
         self.module: Any = None
+
+
+def collect_handlers(modules: Iterable[MModule], handlertype: Type[T]) -> List[T]:
+    """
+    Gets all handlers of a certain type out of a bunch of modules.
+    This does an isinstance check on every handler, so cache the result.
+    """
+    out: List[T] = []
+    for module in modules:
+        out.extend(x for x in module.handlers.values() if isinstance(x, handlertype))
+
+    return out
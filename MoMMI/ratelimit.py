@@ -0,0 +1,117 @@
+import asyncio
+import time
+from typing import Any, Dict, Hashable, Optional, Tuple
+from MoMMI.types import SnowflakeID
+
+
+class MTokenBucket(object):
+    """
+    Classic token bucket: holds up to `capacity` tokens, refilling `capacity` tokens every `per` seconds.
+    """
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, per: float) -> None:
+        self.capacity: float = capacity
+        # Tokens per second.
+        self.rate: float = capacity / per
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, amount: float = 1) -> bool:
+        """
+        Takes tokens if there are enough, returns whether it did.
+        """
+        self.refill()
+        if self.tokens < amount:
+            return False
+
+        self.tokens -= amount
+        return True
+
+    def delay(self, amount: float = 1) -> float:
+        """
+        Seconds until there will be enough tokens.
+        """
+        self.refill()
+        if self.tokens >= amount:
+            return 0
+
+        return (amount - self.tokens) / self.rate
+
+
+# (amount, seconds): at most amount uses every seconds.
+RateType = Tuple[int, float]
+# Prune full buckets once there are this many.
+MAX_BUCKETS = 1024
+
+
+class MRateLimit(object):
+    """
+    Declarative rate limit for a command, pass as rate_limit= to the command decorator.
+
+    per_user, per_channel and total are each an (amount, seconds) tuple, or None to not limit that scope.
+    A use has to fit in every given scope.
+
+    With coalesce enabled, a request identical to one that's still running
+    (same channel, same message text and attachments) joins that one instead of starting more work.
+    Joined requests don't count against the limits.
+    """
+
+    def __init__(self,
+                 per_user: Optional[RateType] = None,
+                 per_channel: Optional[RateType] = None,
+                 total: Optional[RateType] = None,
+                 coalesce: bool = True) -> None:
+
+        self.scopes: Dict[str, RateType] = {}
+        if per_user is not None:
+            self.scopes["user"] = per_user
+
+        if per_channel is not None:
+            self.scopes["channel"] = per_channel
+
+        if total is not None:
+            self.scopes["total"] = total
+
+        self.coalesce: bool = coalesce
+        self.buckets: Dict[Tuple[str, Any], MTokenBucket] = {}
+        self.in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    def get_bucket(self, scope: str, key: Any) -> MTokenBucket:
+        bucket = self.buckets.get((scope, key))
+        if bucket is None:
+            if len(self.buckets) >= MAX_BUCKETS:
+                self.prune()
+
+            amount, per = self.scopes[scope]
+            bucket = self.buckets[(scope, key)] = MTokenBucket(amount, per)
+
+        return bucket
+
+    def prune(self) -> None:
+        """
+        Drop buckets that refilled completely, they're no different from new ones.
+        """
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill()
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[key]
+
+    def try_take(self, user: SnowflakeID, channel: SnowflakeID) -> bool:
+        """
+        Takes a use from every scope if all of them have one left, returns whether it did.
+        """
+        keys = {"user": user, "channel": channel, "total": None}
+        buckets = [self.get_bucket(scope, keys[scope]) for scope in self.scopes]
+        if any(bucket.delay() > 0 for bucket in buckets):
+            return False
+
+        for bucket in buckets:
+            bucket.try_take()
+
+        return True
@@ -0,0 +1,260 @@
+import logging
+import re
+import string
+from typing import Dict, List, Tuple, Optional, Match, Pattern, TYPE_CHECKING
+from MoMMI.commands import MCommand
+from MoMMI.context import MMessageContext
+from MoMMI.types import SnowflakeID
+
+if TYPE_CHECKING:
+    from MoMMI.master import MoMMI
+
+logger = logging.getLogger(__name__)
+
+LITERAL_CHARS = frozenset(string.ascii_letters + string.digits + "_")
+QUANTIFIER_CHARS = frozenset("?*{")
+
+# (registration index, command)
+IndexedCommand = Tuple[int, MCommand]
+
+
+class MCommandTrieNode(object):
+    __slots__ = ("children", "commands")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, MCommandTrieNode] = {}
+        # Commands whose literal prefix ends at this node.
+        self.commands: List[IndexedCommand] = []
+
+
+class MCommandRouter(object):
+    """
+    Figures out which commands apply to a message without running every single regex against it.
+
+    Prefixed commands get sorted into a trie by the literal text their regex starts with,
+    so only commands whose keyword the message actually starts with get their regex ran.
+    Commands we can't extract a keyword out of get checked every time.
+
+    Built once per module reload, see MoMMI.reload_modules.
+    """
+
+    def __init__(self, master: "MoMMI") -> None:
+        self.master: "MoMMI" = master
+        self.built: bool = False
+        self.root: MCommandTrieNode = MCommandTrieNode()
+        # Longest keyword in the trie, no reason to walk further than this.
+        self.depth: int = 0
+        # Prefixed commands without a keyword.
+        self.fallback: List[IndexedCommand] = []
+        # always_commands, ran on every message.
+        self.always: List[IndexedCommand] = []
+        # Results of MCommand.channel_filter, by (id(command), channel).
+        self.channel_filter_cache: Dict[Tuple[int, SnowflakeID], bool] = {}
+
+    def invalidate(self) -> None:
+        """
+        Marks the router as outdated, it'll be rebuilt on the next message.
+        """
+        self.built = False
+
+    def invalidate_filters(self) -> None:
+        """
+        Drops cached channel filter results, for when the config they're based on changes.
+        """
+        self.channel_filter_cache = {}
+
+    def build(self) -> None:
+        root = MCommandTrieNode()
+        depth = 0
+        fallback: List[IndexedCommand] = []
+        always: List[IndexedCommand] = []
+
+        for index, command in enumerate(self.master.iter_global_handlers(MCommand)):
+            if not command.prefix:
+                always.append((index, command))
+                continue
+
+            keyword = ""
+            if command.regex is not None:
+                keyword = literal_prefix(command.regex)
+
+            if not keyword:
+                fallback.append((index, command))
+                continue
+
+            node = root
+            for char in keyword:
+                node = node.children.setdefault(char, MCommandTrieNode())
+
+            node.commands.append((index, command))
+            depth = max(depth, len(keyword))
+
+        self.root = root
+        self.depth = depth
+        self.fallback = fallback
+        self.always = always
+        self.channel_filter_cache = {}
+        self.built = True
+
+        logger.debug(f"Built command router: {len(always)} always, {len(fallback)} fallback, trie depth {depth}.")
+
+    def route(self, context: MMessageContext) -> List[Tuple[MCommand, Optional[Match]]]:
+        """
+        Returns every command that should be executed for a message along with its regex match,
+        in the order they were registered.
+        """
+        if not self.built:
+            self.build()
+
+        content = context.content
+        from_self = context.from_self
+        modules = context.channel.server.modules
+
+        found: List[Tuple[int, MCommand, Optional[Match]]] = []
+
+        for index, command in self.always:
+            if from_self and not command.unsafe:
+                continue
+
+            if command.module not in modules:
+                continue
+
+            if command.has_filters and not self.passes_filters(command, context):
+                continue
+
+            match = None
+            if command.regex is not None:
+                match = command.match(content)
+                if match is None:
+                    continue
+
+            found.append((index, command, match))
+
+        body = context.command_body
+        if body is not None:
+            candidates = list(self.fallback)
+            node = self.root
+            for char in body[:self.depth].lower():
+                child = node.children.get(char)
+                if child is None:
+                    break
+
+                candidates.extend(child.commands)
+                node = child
+
+            for index, command in candidates:
+                if from_self and not command.unsafe:
+                    continue
+
+                if command.module not in modules:
+                    continue
+
+                if command.has_filters and not self.passes_filters(command, context):
+                    continue
+
+                match = context.prefix_match
+                if command.regex is not None:
+                    match = command.match(body)
+                    if match is None:
+                        continue
+
+                found.append((index, command, match))
+
+        found.sort(key=lambda x: x[0])
+        return [(command, match) for _, command, match in found]
+
+    def passes_filters(self, command: MCommand, context: MMessageContext) -> bool:
+        """
+        Checks the cheap pre-filters of a command, see always_command.
+        """
+        length = len(context.content)
+        if length < command.min_length:
+            return False
+
+        if command.max_length is not None and length > command.max_length:
+            return False
+
+        if command.ignore_relayed and context.relayed:
+            return False
+
+        if command.ignore_bots and context.from_bot:
+            return False
+
+        if command.contains is not None and command.contains not in context.lowered:
+            return False
+
+        if command.needs_attachments and not context.message.attachments:
+            return False
+
+        if command.channel_filter is not None:
+            channel = context.channel
+            key = (id(command), channel.id)
+            allowed = self.channel_filter_cache.get(key)
+            if allowed is None:
+                try:
+                    allowed = bool(command.channel_filter(channel))
+                except:
+                    # Not cached, the filter might well work next time.
+                    logger.exception(f"Exception in channel filter of command {command.module}/{command.name}.")
+                    return False
+
+                self.channel_filter_cache[key] = allowed
+
+            if not allowed:
+                return False
+
+        return True
+
+
+def literal_prefix(regex: Pattern) -> str:
+    """
+    Gets the literal text every match of the regex has to start with, lowercased.
+    This is conservative: if we can't be sure, an empty string is returned.
+    """
+    pattern: str = regex.pattern
+    if regex.flags & re.VERBOSE or has_top_level_alternation(pattern):
+        return ""
+
+    prefix: List[str] = []
+    for char in pattern:
+        if char in LITERAL_CHARS:
+            prefix.append(char)
+            continue
+
+        # The last character is optional, so it's not part of the prefix.
+        if char in QUANTIFIER_CHARS and prefix:
+            prefix.pop()
+
+        break
+
+    return "".join(prefix).lower()
+
+
+def has_top_level_alternation(pattern: str) -> bool:
+    depth = 0
+    in_class = False
+    escaped = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+
+        elif char == "\\":
+            escaped = True
+
+        elif in_class:
+            if char == "]":
+                in_class = False
+
+        elif char == "[":
+            in_class = True
+
+        elif char == "(":
+            depth += 1
+
+        elif char == ")":
+            depth -= 1
+
+        elif char == "|" and depth == 0:
+            return True
+
+    return False
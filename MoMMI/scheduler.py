@@ -0,0 +1,157 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Callable, Awaitable, Deque, Dict, Optional, Set, Any, TYPE_CHECKING
+from MoMMI.types import SnowflakeID
+
+if TYPE_CHECKING:
+    from MoMMI.channel import MChannel
+    from MoMMI.master import MoMMI
+
+logger = logging.getLogger(__name__)
+
+JobType = Callable[[], Awaitable[None]]
+
+
+class MDispatchLane(object):
+    """
+    The queue of jobs for a single channel.
+    """
+    __slots__ = ("jobs", "worker")
+
+    def __init__(self) -> None:
+        self.jobs: Deque[JobType] = deque()
+        self.worker: Optional[asyncio.Future] = None
+
+
+class MDispatchScheduler(object):
+    """
+    Runs handlers concurrently, without letting one slow handler stall the rest of the bot.
+
+    Every channel gets a lane: jobs in a lane start in the order they were submitted,
+    and the next job only starts once the previous one finished, so output on a channel stays ordered.
+    If a job takes longer than `dispatch.detach_after` seconds it gets detached:
+    it keeps running in the background but the rest of its lane carries on without it.
+    That's counted from when the job actually started, not from when it started waiting for a slot.
+
+    Running jobs are capped globally and per server.
+    """
+
+    def __init__(self, master: "MoMMI", loop: asyncio.AbstractEventLoop) -> None:
+        self.master: "MoMMI" = master
+        self.loop = loop
+
+        self.max_concurrent: int = master.config.get_main("dispatch.max_concurrent", 32)
+        self.max_per_server: int = master.config.get_main("dispatch.max_per_server", 8)
+        self.detach_after: float = master.config.get_main("dispatch.detach_after", 2.0)
+
+        self.lanes: Dict[SnowflakeID, MDispatchLane] = {}
+        self.global_semaphore = asyncio.Semaphore(self.max_concurrent)
+        self.server_semaphores: Dict[SnowflakeID, asyncio.Semaphore] = {}
+        self.tasks: Set[asyncio.Future] = set()
+
+        # Statistics.
+        self.queued: int = 0
+        self.running: int = 0
+        self.detached: int = 0
+        self.completed: int = 0
+
+    def submit(self, channel: "MChannel", job: JobType) -> None:
+        """
+        Queues a job on the lane of a channel.
+        The job is only called (and thus its coroutine only created) once it's its turn.
+        """
+        lane = self.lanes.get(channel.id)
+        if lane is None:
+            lane = self.lanes[channel.id] = MDispatchLane()
+
+        lane.jobs.append(job)
+        self.queued += 1
+
+        if lane.worker is None:
+            lane.worker = asyncio.ensure_future(self.run_lane(channel.id, channel.server.id, lane), loop=self.loop)
+
+    async def run_lane(self, key: SnowflakeID, server: SnowflakeID, lane: MDispatchLane) -> None:
+        try:
+            while lane.jobs:
+                job = lane.jobs.popleft()
+                self.queued -= 1
+
+                started = asyncio.Event()
+                task = asyncio.ensure_future(self.run_job(server, job, started), loop=self.loop)
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+                # A job waiting for a slot isn't slow, it must not get detached over that.
+                waiter = asyncio.ensure_future(started.wait(), loop=self.loop)
+                try:
+                    await asyncio.wait([task, waiter], return_when=asyncio.FIRST_COMPLETED)
+
+                finally:
+                    waiter.cancel()
+
+                done, _ = await asyncio.wait([task], timeout=self.detach_after)
+                if not done:
+                    self.detached += 1
+                    logger.debug(f"Detached slow job on channel {key}, {len(lane.jobs)} jobs waiting behind it.")
+
+        finally:
+            lane.worker = None
+            if not lane.jobs and self.lanes.get(key) is lane:
+                del self.lanes[key]
+
+    async def run_job(self, server: SnowflakeID, job: JobType, started: asyncio.Event) -> None:
+        semaphore = self.server_semaphores.get(server)
+        if semaphore is None:
+            semaphore = self.server_semaphores[server] = asyncio.Semaphore(self.max_per_server)
+
+        # Server first, so a busy server doesn't sit on global slots while waiting for its own.
+        async with semaphore:
+            async with self.global_semaphore:
+                started.set()
+                self.running += 1
+                try:
+                    await job()
+
+                except:
+                    logger.exception("Exception in dispatched job!")
+
+                finally:
+                    self.running -= 1
+                    self.completed += 1
+
+    def queue_depth(self, channel: Optional["MChannel"] = None) -> int:
+        """
+        Amount of jobs waiting to be started, for a single channel or in total.
+        """
+        if channel is None:
+            return self.queued
+
+        lane = self.lanes.get(channel.id)
+        if lane is None:
+            return 0
+
+        return len(lane.jobs)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "lanes": len(self.lanes),
+            "detached": self.detached,
+            "completed": self.completed,
+        }
+
+    async def drain(self, timeout: float) -> None:
+        """
+        Waits for running jobs and the jobs still queued in lanes to finish, for at most timeout seconds.
+        """
+        deadline = self.loop.time() + timeout
+        while True:
+            # Lane workers start more jobs as they go, so look again every time something finishes.
+            pending = self.tasks | {lane.worker for lane in self.lanes.values() if lane.worker is not None}
+            remaining = deadline - self.loop.time()
+            if not pending or remaining <= 0:
+                return
+
+            await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple, TYPE_CHECKING
+from MoMMI.commands import RELAYED_MARKER
+from MoMMI.ratelimit import MTokenBucket
+
+if TYPE_CHECKING:
+    from MoMMI.channel import MChannel
+
+logger = logging.getLogger(__name__)
+
+# Discord refuses messages longer than this.
+MAX_MESSAGE_LENGTH = 2000
+
+
+class MOutgoingMessage(object):
+    __slots__ = ("content", "kwargs", "future", "queued")
+
+    def __init__(self, content: str, kwargs: Dict[str, Any], future: asyncio.Future) -> None:
+        self.content: str = content
+        self.kwargs: Dict[str, Any] = kwargs
+        self.future: asyncio.Future = future
+        self.queued: float = time.monotonic()
+
+    @property
+    def coalescable(self) -> bool:
+        return bool(self.content) and not self.kwargs
+
+
+class MSendQueue(object):
+    """
+    Outgoing messages for a single channel.
+    Messages get sent in order, paced with a token bucket so we stay under Discord's rate limits
+    instead of having a burst of messages run into 429s.
+    If coalescing is enabled, consecutive plain text messages get merged into one where they fit.
+    The `[send]` config is picked up again whenever the config is reloaded.
+    """
+
+    def __init__(self, channel: "MChannel") -> None:
+        master = channel.server.master
+        self.channel: "MChannel" = channel
+        self.loop = master.client.loop
+        self.bucket = MTokenBucket(5, 5.0)
+        # send.rate and send.per the bucket was made with.
+        self.pace: Tuple[float, float] = (5, 5.0)
+        self.coalesce: bool = False
+        # Config generation the settings above were read at, see load_config().
+        self.generation: int = -1
+        self.pending: Deque[MOutgoingMessage] = deque()
+        self.worker: Optional[asyncio.Future] = None
+        self.load_config()
+
+    def load_config(self) -> None:
+        """
+        (Re)reads the send settings if the config changed since they were last read.
+        """
+        config = self.channel.server.master.config
+        if config.generation == self.generation:
+            return
+
+        pace = (config.get_main("send.rate", 5), config.get_main("send.per", 5.0))
+        if self.generation < 0:
+            self.bucket = MTokenBucket(*pace)
+
+        elif pace != self.pace:
+            bucket = MTokenBucket(*pace)
+            # Don't hand out a fresh burst just because the settings changed.
+            self.bucket.refill()
+            bucket.tokens = min(bucket.capacity, self.bucket.tokens)
+            self.bucket = bucket
+
+        self.pace = pace
+        self.generation = config.generation
+        self.coalesce = config.get_main("send.coalesce", False)
+
+    async def send(self, content: str, **kwargs: Any) -> None:
+        self.load_config()
+        future = self.loop.create_future()
+        self.pending.append(MOutgoingMessage(content, kwargs, future))
+        if self.worker is None:
+            self.worker = asyncio.ensure_future(self.run(), loop=self.loop)
+
+        await future
+
+    async def run(self) -> None:
+        try:
+            while self.pending:
+                delay = self.bucket.delay()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                self.bucket.try_take()
+                await self.send_batch(self.next_batch())
+
+        finally:
+            self.worker = None
+
+    def next_batch(self) -> List[MOutgoingMessage]:
+        first = self.pending.popleft()
+        batch = [first]
+        if not self.coalesce or not first.coalescable:
+            return batch
+
+        # Relayed messages are only merged with each other,
+        # so that the merged message as a whole gets recognized as relayed or not.
+        relayed = first.content.startswith(RELAYED_MARKER)
+        length = len(first.content)
+        while self.pending:
+            upcoming = self.pending[0]
+            if not upcoming.coalescable or length + 1 + len(upcoming.content) > MAX_MESSAGE_LENGTH:
+                break
+
+            if upcoming.content.startswith(RELAYED_MARKER) != relayed:
+                break
+
+            length += 1 + len(upcoming.content)
+            batch.append(self.pending.popleft())
+
+        return batch
+
+    async def send_batch(self, batch: List[MOutgoingMessage]) -> None:
+        master = self.channel.server.master
+        now = time.monotonic()
+        for message in batch:
+            master.metrics.observe("send_queue_wait", (now - message.queued) * 1000)
+
+        if len(batch) > 1:
+            master.metrics.count("send_coalesced", len(batch) - 1)
+
+        content = "\n".join(message.content for message in batch)
+        try:
+            await master.client.send_message(self.channel.get_channel(), content, **batch[0].kwargs)
+
+        except Exception as e:
+            for message in batch:
+                if not message.future.done():
+                    message.future.set_exception(e)
+
+        else:
+            for message in batch:
+                if not message.future.done():
+                    message.future.set_result(None)
+
+    @property
+    def depth(self) -> int:
+        return len(self.pending)
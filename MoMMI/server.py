@@ -1,16 +1,15 @@
 
-import asyncio
 import logging
-import pickle
-from typing import Dict, Any, TypeVar, Optional, Union, cast, List, Set
+from typing import Dict, Any, TypeVar, Optional, Union, cast, List, Set, Type
 from pathlib import Path
-import aiofiles
 from discord import Server, Channel, Member, Role
 from MoMMI.types import SnowflakeID, MIdentifier
 from MoMMI.master import MoMMI
-from MoMMI.module import MModule
+from MoMMI.module import MModule, collect_handlers
 from MoMMI.role import MRoleType
 from MoMMI.channel import MChannel
+from MoMMI.config import ConfigLookup
+from MoMMI.storage import MStorage, open_backend
 
 logger = logging.getLogger(__name__)
 T = TypeVar("T")
@@ -23,18 +22,22 @@ class MServer(object):
     """
 
     def __init__(self, server: Server, master: MoMMI) -> None:
-        # The TOML data from the config file, directly.
-        self.config: Dict[str, Any] = {}
+        # The TOML data from the config file, see config below.
+        self.config_lookup = ConfigLookup({})
+        # Internal channel names from the config by channel ID, kept up to date with the config.
+        self.channel_names: Dict[SnowflakeID, str] = {}
 
         # The server snowflake ID.
         self.id: SnowflakeID = SnowflakeID(server.id)
 
         # Enabled modules for this Server.
         self.modules: Dict[str, MModule] = {}
+        # Handlers of the enabled modules by type, see get_handlers.
+        self.handler_index: Dict[type, List[Any]] = {}
 
         # Data storage for modules.
-        # As long as the data pickles fine it can be stored.
-        self.storage: Dict[str, Any] = {}
+        # As long as the data pickles fine (or has a codec, see MoMMI.storageformat) it can be stored.
+        self.storage = MStorage()
 
         # Cache is persistent through reloads, but not through restarts.
         self.cache: Dict[str, Any] = {}
@@ -72,11 +75,30 @@ class MServer(object):
 
         raise KeyError(identifier)
 
+    @property
+    def config(self) -> Dict[str, Any]:
+        """
+        The TOML data from the config file, directly.
+        """
+        return self.config_lookup.data
+
+    @config.setter
+    def config(self, value: Dict[str, Any]) -> None:
+        self.config_lookup = ConfigLookup(value)
+        names: Dict[SnowflakeID, str] = {}
+        for name, snowflake in value.get("channels", {}).items():
+            # First name wins if a channel has several, they all still work for get_channel.
+            names.setdefault(SnowflakeID(snowflake), name)
+
+        self.channel_names = names
+
     # Gets passed a section of servers.toml and loads it.
+    # Also used on config reloads, so everything derived from the config gets replaced rather than added to.
     def load_server_config(self, config: Dict[str, Any]) -> None:
         self.config = config
         self.name = config["name"]
 
+        roles: Dict[MRoleType, Set[SnowflakeID]] = {}
         for rolename, snowflake in self.config.get("roles", {}).items():
             l = set()
             if isinstance(snowflake, List):
@@ -84,24 +106,18 @@ class MServer(object):
                     l.add(SnowflakeID(roleid))
             else:
                 l.add(SnowflakeID(snowflake))
-            self.roles[MRoleType[rolename]] = l
+            roles[MRoleType[rolename]] = l
 
+        self.roles = roles
         self.init_channel_names()
 
     async def load_data_storages(self, source: Path) -> None:
+        """
+        Opens the storage of this server in source. The storages themselves get loaded in the background.
+        """
         self.storagedir = source
-        await asyncio.gather(*(self.load_single_storage(m.name, m) for m in source.iterdir()))
-
-    async def load_single_storage(self, module: str, file: Path) -> None:
-        data: Any
-        try:
-            async with aiofiles.open(file, "rb") as f:
-                data = pickle.loads(await f.read())
-
-            self.storage[module] = data
-
-        except:
-            logger.exception(f"Failed to load storage {module} for server {self.name}")
+        await self.storage.open(open_backend(self.master, source), self.master)
+        self.storage.start_prefetch()
 
     def get_channel(self, snowflake: MIdentifier) -> MChannel:
         """
@@ -115,27 +131,41 @@ class MServer(object):
 
         raise TypeError()
 
+    def get_handlers(self, handlertype: Type[T]) -> List[T]:
+        """
+        Get all handlers of a type for the modules enabled on this server.
+        The list is cached until handlers change, so don't modify it.
+        """
+        handlers: Optional[List[T]] = self.handler_index.get(handlertype)
+        if handlers is None:
+            handlers = self.handler_index[handlertype] = collect_handlers(self.modules.values(), handlertype)
+
+        return handlers
+
     def get_server(self) -> Server:
         return self.master.client.get_server(str(self.id))
 
     def add_channel(self, channel: Channel) -> None:
-        name = None
-        for k, v in self.config.get("channels", {}).items():
-            if int(v) == int(channel.id):
-                name = k
-                break
-
+        name = self.channel_names.get(SnowflakeID(channel.id))
         channel = MChannel(self, channel, name)
         self.channels[SnowflakeID(channel.id)] = channel
         if name:
             self.channels_name[name] = channel
 
+        self.master.invalidate_comm_routes()
+
     def init_channel_names(self) -> None:
+        names: Dict[str, MChannel] = {}
         for k, v in self.config.get("channels", {}).items():
             sid = SnowflakeID(v)
             if sid in self.channels:
-                self.channels_name[k] = self.channels[sid]
-                self.channels[sid].internal_name = k
+                names[k] = self.channels[sid]
+
+        for sid, channel in self.channels.items():
+            channel.internal_name = self.channel_names.get(sid)
+
+        self.channels_name = names
+        self.master.invalidate_comm_routes()
 
     def remove_channel(self, channel: Channel) -> None:
         channel = self.get_channel(SnowflakeID(channel.id))
@@ -143,15 +173,34 @@ class MServer(object):
             del self.channels_name[channel.internal_name]
 
         del self.channels[SnowflakeID(channel.id)]
+        self.master.invalidate_comm_routes()
 
     def get_storage(self, name: str) -> Any:
-        return self.storage[name]
+        return self.storage.get(name)
 
     def set_storage(self, name: str, value: Any) -> None:
-        self.storage[name] = value
+        self.storage.set(name, value)
+
+    async def load_storage(self, name: str) -> None:
+        """
+        Makes sure a storage is loaded without blocking, so get_storage() doesn't have to load it on the loop.
+        """
+        await self.storage.load(name)
 
     def has_storage(self, name: str) -> bool:
-        return name in self.storage
+        return self.storage.has(name)
+
+    def mark_storage_dirty(self, name: str) -> None:
+        """
+        Marks a storage as changed so it gets saved, for storages modified in place.
+        """
+        self.storage.mark_dirty(name)
+
+    def schedule_storage_save(self, name: str) -> None:
+        """
+        Saves a storage some time soon, together with other storages changed around the same time.
+        """
+        self.storage.schedule_save(name)
 
     async def set_storage_save(self, name: str, value: Any) -> None:
         self.set_storage(name, value)
@@ -161,19 +210,17 @@ class MServer(object):
         if self.storagedir is None:
             raise RuntimeError("Storage dir has not been set. Cannot save storages!")
 
-        storage = self.get_storage(name)
-        data = pickle.dumps(storage)
-        async with aiofiles.open(self.storagedir.joinpath(name), "wb") as f:
-            await f.write(data)
+        await self.storage.save(name)
 
     async def save_all_storages(self) -> None:
+        """
+        Saves every storage that changed since it was last saved.
+        """
         if self.storagedir is None:
             return
 
         logger.debug(f"Saving storage for server {self.name}!")
-        await asyncio.gather(
-            *(self.save_storage(x) for x in self.storage)
-        )
+        await self.storage.save_dirty()
 
     def get_cache(self, name: str) -> Any:
         return self.cache[name]
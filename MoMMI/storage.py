@@ -0,0 +1,714 @@
+import asyncio
+import itertools
+import logging
+import os
+import select
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+from MoMMI.storageformat import MStorageFormatError, decode_entry, encode_entry
+
+if TYPE_CHECKING:
+    from MoMMI.master import MoMMI
+
+logger = logging.getLogger(__name__)
+
+
+class MStorageBackend(object):
+    """
+    Where the serialized storage entries of a single server (or the global storage) live.
+    All methods block, so they're ran in an executor by MStorage.
+    """
+
+    def keys(self) -> List[str]:
+        raise NotImplementedError()
+
+    def sizes(self) -> Dict[str, int]:
+        """
+        Every key along with the size of its data in bytes.
+        """
+        raise NotImplementedError()
+
+    def read(self, key: str) -> bytes:
+        """
+        Raises KeyError if the key doesn't exist.
+        """
+        raise NotImplementedError()
+
+    def write(self, key: str, data: bytes) -> None:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+class MFileStorageBackend(MStorageBackend):
+    """
+    One file per key in a directory. This is the layout MoMMI has always used.
+
+    Writes go to a temporary file that then replaces the old one, so a crash never leaves a half written file.
+    With fsync, the data and the rename are also flushed to the disk before write returns.
+    """
+
+    def __init__(self, directory: Path, fsync: bool = False) -> None:
+        self.directory: Path = directory
+        self.fsync: bool = fsync
+
+    def __repr__(self) -> str:
+        return f"MFileStorageBackend({self.directory})"
+
+    def keys(self) -> List[str]:
+        return [path.name for path in self.directory.iterdir() if path.is_file() and not path.name.startswith(".")]
+
+    def sizes(self) -> Dict[str, int]:
+        return {key: (self.directory/key).stat().st_size for key in self.keys()}
+
+    def read(self, key: str) -> bytes:
+        try:
+            return (self.directory/key).read_bytes()
+
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def write(self, key: str, data: bytes) -> None:
+        # Dotfiles are skipped by keys(), so a leftover from a crash never gets loaded.
+        temp = self.directory/f".{key}.tmp"
+        with temp.open("wb") as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+        os.replace(str(temp), str(self.directory/key))
+
+        if self.fsync and hasattr(os, "O_DIRECTORY"):
+            # Make the rename itself durable.
+            fd = os.open(str(self.directory), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+class MSQLiteStorageBackend(MStorageBackend):
+    """
+    A single SQLite database, one row per key.
+    Every write is its own transaction. With fsync, it's flushed to the disk before write returns,
+    otherwise the last writes might be lost on power loss, but the database can't get corrupted.
+    """
+
+    def __init__(self, path: Path, fsync: bool = False) -> None:
+        self.path: Path = path
+        # The connection is shared between executor threads, so we serialize access ourselves.
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS storage (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+
+    def __repr__(self) -> str:
+        return f"MSQLiteStorageBackend({self.path})"
+
+    def keys(self) -> List[str]:
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT key FROM storage")]
+
+    def sizes(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.connection.execute("SELECT key, length(value) FROM storage"))
+
+    def read(self, key: str) -> bytes:
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM storage WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            raise KeyError(key)
+
+        return bytes(row[0])
+
+    def write(self, key: str, data: bytes) -> None:
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO storage (key, value) VALUES (?, ?)", (key, data))
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def open_backend(master: "MoMMI", directory: Path) -> MStorageBackend:
+    """
+    Opens the storage backend selected with `storage.backend` for a storage directory.
+
+    The SQLite backend stores its database next to the directory, as <directory>.sqlite3.
+    When that database is first created, the files of the old directory get imported into it.
+    """
+    kind: str = master.config.get_main("storage.backend", "file")
+    fsync: str = master.config.get_main("storage.fsync", "always")
+    if fsync not in ("always", "never"):
+        raise ValueError(f"Unknown storage fsync policy: {fsync}")
+
+    if kind == "file":
+        directory.mkdir(parents=True, exist_ok=True)
+        return MFileStorageBackend(directory, fsync == "always")
+
+    if kind == "sqlite":
+        path = directory.with_name(directory.name + ".sqlite3")
+        new = not path.exists()
+        backend = MSQLiteStorageBackend(path, fsync == "always")
+        if new and directory.is_dir():
+            legacy = MFileStorageBackend(directory)
+            for key in legacy.keys():
+                backend.write(key, legacy.read(key))
+
+            logger.info(f"Imported {directory} into {path}.")
+
+        return backend
+
+    raise ValueError(f"Unknown storage backend: {kind}")
+
+
+# Forking gives us a copy-on-write snapshot to serialize, without blocking the loop or copying anything.
+# The child is a copy of a process with threads running, so it can deadlock on a lock one of them held at the time.
+# That's why it gets killed if it takes too long, see finish_forked_serialize.
+CAN_FORK = hasattr(os, "fork")
+# Tries at serializing in a thread before giving up and doing it on the loop, see serialize_threaded.
+THREAD_ATTEMPTS = 3
+
+
+def start_forked_serialize(key: str, value: Any) -> Tuple[int, int]:
+    """
+    Forks a child that encodes value and writes it into a pipe.
+    Returns the PID of the child and the read end of the pipe, see finish_forked_serialize.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Child. Must never return or raise, nor run any of the parent's cleanup.
+        status = 1
+        try:
+            os.close(read)
+            # Encode everything before writing, so a failure means an empty pipe instead of a truncated one.
+            data = memoryview(encode_entry(key, value))
+            while data:
+                data = data[os.write(write, data):]
+
+            status = 0
+
+        finally:
+            os._exit(status)
+
+    os.close(write)
+    return pid, read
+
+
+def finish_forked_serialize(pid: int, read: int, timeout: float) -> bytes:
+    """
+    Collects the output of start_forked_serialize. Blocks.
+    Kills the child and raises TimeoutError if it isn't done within timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    chunks = []
+    with os.fdopen(read, "rb", buffering=0) as f:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([f], [], [], remaining)[0]:
+                kill_child(pid)
+                raise TimeoutError(f"Serializer child took longer than {timeout}s.")
+
+            chunk = f.read(65536)
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+
+    data = b"".join(chunks)
+    try:
+        # The pipe only closes once the child is exiting, so this doesn't wait long.
+        _, status = os.waitpid(pid, 0)
+
+    except ChildProcessError:
+        # Somebody else's child watcher reaped it, the data has to speak for itself.
+        status = 0
+
+    if status != 0 or not data:
+        raise RuntimeError(f"Serializer child exited with status {status}.")
+
+    return data
+
+
+def kill_child(pid: int) -> None:
+    try:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    except (ProcessLookupError, ChildProcessError):
+        pass
+
+
+def serialize_threaded(key: str, value: Any) -> Optional[bytes]:
+    """
+    Encodes value in the current (executor) thread.
+    The loop can change value while we encode it, so this returns None if that kept happening.
+    Only changes that resize a container get noticed though: a value replaced in place while we encode
+    can leave the result with part of the old and part of the new state. There's no snapshot here.
+    """
+    for _ in range(THREAD_ATTEMPTS):
+        try:
+            return encode_entry(key, value)
+
+        except RuntimeError:
+            # "dictionary changed size during iteration" and friends.
+            continue
+
+    return None
+
+
+# Containers bigger than this get their memory use extrapolated from this many of their items.
+MEMORY_SAMPLE = 32
+
+
+def estimate_memory(value: Any) -> int:
+    """
+    Rough estimate of the memory used by value and everything in it, in bytes.
+    Cheap even for huge containers, as those get sampled.
+
+    String keys of dicts aren't counted, as those tend to be shared (like the words of a markov chain),
+    and neither are the small ints Python caches.
+    Anything else referenced multiple times gets counted multiple times.
+    """
+    if isinstance(value, int) and -5 <= value <= 256:
+        return 0
+
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        amount = len(value)
+        if amount:
+            sampled = 0
+            for k, v in itertools.islice(value.items(), MEMORY_SAMPLE):
+                if not isinstance(k, str):
+                    sampled += estimate_memory(k)
+
+                sampled += estimate_memory(v)
+
+            size += sampled * amount // min(amount, MEMORY_SAMPLE)
+
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        amount = len(value)
+        if amount:
+            sampled = sum(estimate_memory(x) for x in itertools.islice(value, MEMORY_SAMPLE))
+            size += sampled * amount // min(amount, MEMORY_SAMPLE)
+
+    return size
+
+
+class MStorageSaveStats(object):
+    __slots__ = ("saves", "total_ms", "last_ms", "last_saved")
+
+    def __init__(self) -> None:
+        self.saves: int = 0
+        self.total_ms: float = 0
+        self.last_ms: float = 0
+        # Wall clock time.
+        self.last_saved: float = 0
+
+
+class MStorage(object):
+    """
+    Key-value storage for modules, of a server or global.
+
+    Every entry is kept in memory and gets serialized separately,
+    and only entries that changed since they were last saved get written.
+    set() marks an entry as changed, entries that are mutated in place need mark_dirty().
+
+    schedule_save() is write-behind: instead of saving right away,
+    all entries scheduled within flush_interval seconds get saved together in a single flush.
+    Writes of the same entry never overlap.
+
+    Entries are written with the codec registered for their key, see MoMMI.storageformat.
+    Entries with at least `storage.offload_threshold` items get encoded off the event loop.
+    Where we can fork, a child encodes a copy-on-write snapshot of the entry,
+    so handlers can keep changing it in the mean time.
+    Elsewhere it's encoded in a thread, falling back to the loop if it keeps changing under us.
+    That isn't a snapshot: without fork, a save racing with handlers can write a mix of old and new state.
+    The next save of the entry fixes that, as long as it was marked dirty again.
+    A child that fails or takes longer than `storage.fork_timeout` seconds gets the same fallback,
+    and after one that timed out this storage stops forking altogether.
+
+    Entries aren't loaded when the storage is opened. start_prefetch() loads them in the background,
+    in the executor, and load() does so for a single entry. get() of an entry that isn't loaded yet has to
+    load it right away on the loop, which blocks the bot for as long as that takes, so await load() first
+    for entries that might not be loaded.
+    With `storage.memory_budget` set, the least recently used entries that have been saved get dropped
+    from memory when the loaded entries are over budget, and get loaded again when needed.
+    Entry sizes are estimated by their encoded size.
+    So with a budget, don't hold on to a storage object across awaits: it might not be the stored one anymore.
+
+    Saves and background loads of all storages share a semaphore, so at most `storage.io_parallelism` run at once.
+    """
+
+    def __init__(self) -> None:
+        self.backend: Optional[MStorageBackend] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.flush_interval: float = 5
+        self.offload_threshold: int = 1000
+        self.fork_timeout: float = 60
+        # Turned off when a forked child hangs, see serialize().
+        self.can_fork: bool = CAN_FORK
+        # In bytes, 0 for no limit.
+        self.memory_budget: int = 0
+        self.entries: Dict[str, Any] = {}
+        # Keys that exist in the backend, loaded or not.
+        self.on_disk: Set[str] = set()
+        # Encoded size of entries, as of their last load or save.
+        self.sizes: Dict[str, int] = {}
+        self.save_stats: Dict[str, MStorageSaveStats] = {}
+        self.opened: float = time.time()
+        self.last_used: Dict[str, float] = {}
+        self.dirty: Set[str] = set()
+        # Keys waiting for the next flush.
+        self.scheduled: Set[str] = set()
+        self.flush_handle: Optional[asyncio.Handle] = None
+        self.flush_task: Optional[asyncio.Future] = None
+        self.locks: Dict[str, asyncio.Lock] = {}
+        # Shared between all storages, see open().
+        self.io: Optional[asyncio.Semaphore] = None
+        self.prefetch_task: Optional[asyncio.Future] = None
+
+    def get(self, key: str) -> Any:
+        if key not in self.entries:
+            if key in self.on_disk:
+                logger.warning(f"Storage {key} of {self.backend} wasn't loaded yet, loading it on the loop.")
+
+            self.load_now(key)
+
+        self.last_used[key] = time.monotonic()
+        return self.entries[key]
+
+    def set(self, key: str, value: Any) -> None:
+        self.entries[key] = value
+        self.last_used[key] = time.monotonic()
+        self.dirty.add(key)
+
+    def has(self, key: str) -> bool:
+        return key in self.entries or key in self.on_disk
+
+    def mark_dirty(self, key: str) -> None:
+        if key not in self.entries:
+            raise KeyError(key)
+
+        self.dirty.add(key)
+
+    def schedule_save(self, key: str) -> None:
+        """
+        Marks an entry as changed and saves it with the next flush.
+        """
+        self.mark_dirty(key)
+        self.scheduled.add(key)
+        self.arm_flush()
+
+    def arm_flush(self) -> None:
+        if self.flush_handle is not None or self.backend is None or self.loop is None or not self.scheduled:
+            return
+
+        self.flush_handle = self.loop.call_later(self.flush_interval, self.start_flush)
+
+    def start_flush(self) -> None:
+        self.flush_handle = None
+        self.flush_task = asyncio.ensure_future(self.flush(), loop=self.loop)
+
+    async def flush(self) -> None:
+        """
+        Saves every entry scheduled with schedule_save().
+        """
+        keys = list(self.scheduled)
+        self.scheduled.clear()
+        results = await asyncio.gather(*(self.save(key) for key in keys), return_exceptions=True)
+        for key, result in zip(keys, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to save storage {key} to {self.backend}, retrying next flush.", exc_info=result)
+                if key in self.entries:
+                    self.scheduled.add(key)
+
+        self.arm_flush()
+
+    async def open(self, backend: MStorageBackend, master: "MoMMI") -> None:
+        """
+        Attaches the backend. Entries are loaded once they're needed.
+        """
+        self.backend = backend
+        self.loop = master.client.loop
+        self.flush_interval = master.config.get_main("storage.flush_interval", 5.0)
+        self.offload_threshold = master.config.get_main("storage.offload_threshold", 1000)
+        self.fork_timeout = master.config.get_main("storage.fork_timeout", 60.0)
+        self.memory_budget = int(master.config.get_main("storage.memory_budget", 0) * 1024 * 1024)
+        if master.storage_io is None:
+            master.storage_io = asyncio.Semaphore(master.config.get_main("storage.io_parallelism", 4))
+
+        self.io = master.storage_io
+        self.opened = time.time()
+        self.sizes = await self.loop.run_in_executor(None, backend.sizes)
+        self.on_disk = set(self.sizes)
+
+        # What's on disk wins over anything set before we were opened, like it did when everything was loaded up front.
+        for key in self.on_disk.intersection(self.entries):
+            logger.warning(f"Storage {key} was set before {backend} was opened, using the stored one.")
+            del self.entries[key]
+            self.dirty.discard(key)
+            self.scheduled.discard(key)
+
+        # Saves scheduled before we were opened.
+        self.arm_flush()
+
+    def load_now(self, key: str) -> None:
+        """
+        Loads an entry right away, on the loop.
+        Raises KeyError if it doesn't exist or can't be read,
+        MStorageFormatError if it exists but we don't know how to decode it.
+        """
+        if self.backend is None or key not in self.on_disk:
+            raise KeyError(key)
+
+        start = time.monotonic()
+        try:
+            data = self.backend.read(key)
+            value = decode_entry(data)
+
+        except MStorageFormatError:
+            logger.exception(f"Failed to decode storage {key} from {self.backend}")
+            raise
+
+        except:
+            logger.exception(f"Failed to load storage {key} from {self.backend}")
+            raise KeyError(key)
+
+        self.loaded(key, value, len(data))
+        logger.debug(f"Loaded storage {key} from {self.backend} in {(time.monotonic() - start) * 1000:.1f}ms.")
+
+    async def load(self, key: str) -> None:
+        """
+        Loads an entry in the executor, if it isn't loaded yet.
+        Call this ahead of time to keep the first access to a big entry from blocking the loop.
+        """
+        if self.backend is None or self.loop is None or self.io is None:
+            raise RuntimeError("Storage has not been opened!")
+
+        if key in self.entries or key not in self.on_disk:
+            return
+
+        async with self.get_lock(key):
+            # Somebody else might've loaded it while we waited for the lock.
+            if key in self.entries:
+                return
+
+            try:
+                async with self.io:
+                    start = time.monotonic()
+                    data = await self.loop.run_in_executor(None, self.backend.read, key)
+
+                value = await self.loop.run_in_executor(None, decode_entry, data)
+
+            except:
+                logger.exception(f"Failed to load storage {key} from {self.backend}")
+                return
+
+            # Somebody might have set it while we were loading.
+            if key not in self.entries:
+                self.loaded(key, value, len(data))
+
+        logger.debug(f"Loaded storage {key} from {self.backend} in {(time.monotonic() - start) * 1000:.1f}ms.")
+
+    def start_prefetch(self) -> None:
+        """
+        Starts loading entries in the background, see prefetch().
+        """
+        self.prefetch_task = asyncio.ensure_future(self.prefetch(), loop=self.loop)
+
+    async def prefetch(self) -> None:
+        """
+        Loads entries in the executor, smallest first so as many as possible are ready soon.
+        With a memory budget, stops before going over it instead of evicting what it just loaded.
+        """
+        total = sum(self.sizes.get(key, 0) for key in self.entries)
+        for key in sorted(self.on_disk, key=lambda x: self.sizes.get(x, 0)):
+            if key in self.entries:
+                continue
+
+            total += self.sizes.get(key, 0)
+            if self.memory_budget and total > self.memory_budget:
+                break
+
+            await self.load(key)
+
+        logger.debug(f"Prefetched storage of {self.backend}.")
+
+    def loaded(self, key: str, value: Any, size: int) -> None:
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.last_used[key] = time.monotonic()
+        self.dirty.discard(key)
+        self.scheduled.discard(key)
+        self.evict(keep=key)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """
+        Drops saved entries from memory, least recently used first, until we're under the memory budget.
+        """
+        if not self.memory_budget:
+            return
+
+        total = sum(self.sizes.get(key, 0) for key in self.entries)
+        if total <= self.memory_budget:
+            return
+
+        for key in sorted(self.entries, key=lambda x: self.last_used.get(x, 0)):
+            if total <= self.memory_budget:
+                break
+
+            if key == keep or key in self.dirty or key not in self.on_disk or self.get_lock(key).locked():
+                continue
+
+            total -= self.sizes.get(key, 0)
+            del self.entries[key]
+            logger.debug(f"Evicted storage {key} of {self.backend} from memory.")
+
+    async def serialize(self, key: str) -> bytes:
+        """
+        Encodes an entry as it is right now.
+        """
+        if self.loop is None:
+            raise RuntimeError("Storage has not been opened!")
+
+        value = self.entries[key]
+        try:
+            small = len(value) < self.offload_threshold
+        except TypeError:
+            small = True
+
+        if small:
+            return encode_entry(key, value)
+
+        if self.can_fork:
+            try:
+                pid, read = start_forked_serialize(key, value)
+                return await self.loop.run_in_executor(None, finish_forked_serialize, pid, read, self.fork_timeout)
+
+            except TimeoutError:
+                logger.error(f"Forked encoding of storage {key} hung, not forking for {self.backend} anymore.")
+                self.can_fork = False
+
+            except (OSError, RuntimeError):
+                logger.exception(f"Forked encoding of storage {key} failed, encoding it in a thread instead.")
+
+        data = await self.loop.run_in_executor(None, serialize_threaded, key, value)
+        if data is None:
+            logger.warning(f"Storage {key} kept changing while encoding it in a thread, encoding on the loop.")
+            data = encode_entry(key, value)
+
+        return data
+
+    def get_lock(self, key: str) -> asyncio.Lock:
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+
+        return lock
+
+    async def save(self, key: str) -> None:
+        if self.backend is None or self.loop is None:
+            raise RuntimeError("Storage has not been opened. Cannot save storages!")
+
+        if key not in self.entries and key in self.on_disk:
+            # Not loaded, so it can't have changed.
+            return
+
+        if self.io is None:
+            raise RuntimeError("Storage has not been opened. Cannot save storages!")
+
+        async with self.get_lock(key), self.io:
+            # Cleared before writing, so changes made while we write mark it again.
+            self.dirty.discard(key)
+            self.scheduled.discard(key)
+            try:
+                start = time.monotonic()
+                data = await self.serialize(key)
+                serialized = time.monotonic()
+                await self.loop.run_in_executor(None, self.backend.write, key, data)
+
+            except:
+                self.dirty.add(key)
+                raise
+
+            self.on_disk.add(key)
+            self.sizes[key] = len(data)
+            end = time.monotonic()
+
+            stats = self.save_stats.get(key)
+            if stats is None:
+                stats = self.save_stats[key] = MStorageSaveStats()
+
+            stats.saves += 1
+            stats.last_ms = (end - start) * 1000
+            stats.total_ms += stats.last_ms
+            stats.last_saved = time.time()
+            logger.debug(f"Saved storage {key} ({len(data)} bytes) to {self.backend} in {(end - start) * 1000:.1f}ms"
+                         f" ({(serialized - start) * 1000:.1f}ms encoding).")
+
+        self.evict()
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Per entry: stored size, estimated memory use (0 if not loaded) and save statistics.
+        Save frequency is in saves per hour since the storage was opened.
+        """
+        hours = max(time.time() - self.opened, 60) / 3600
+        out = {}
+        for key in sorted(self.on_disk.union(self.entries)):
+            stats = self.save_stats.get(key) or MStorageSaveStats()
+            out[key] = {
+                "size": self.sizes.get(key, 0),
+                "memory": estimate_memory(self.entries[key]) if key in self.entries else 0,
+                "loaded": key in self.entries,
+                "dirty": key in self.dirty,
+                "saves": stats.saves,
+                "saves_per_hour": round(stats.saves / hours, 2),
+                "last_save_ms": round(stats.last_ms, 1),
+                "mean_save_ms": round(stats.total_ms / stats.saves, 1) if stats.saves else 0,
+                "last_saved": stats.last_saved,
+            }
+
+        return out
+
+    async def save_dirty(self) -> None:
+        """
+        Saves every entry that changed since it was last saved.
+        """
+        await asyncio.gather(*(self.save(key) for key in list(self.dirty)))
+
+    async def close(self) -> None:
+        """
+        Saves everything that changed and detaches the backend.
+        """
+        if self.prefetch_task is not None:
+            self.prefetch_task.cancel()
+            await asyncio.wait([self.prefetch_task])
+            self.prefetch_task = None
+
+        if self.flush_task is not None:
+            await asyncio.wait([self.flush_task])
+
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if self.backend is None or self.loop is None:
+            return
+
+        await self.save_dirty()
+        backend = self.backend
+        # No more flushes from here on.
+        self.backend = None
+        await self.loop.run_in_executor(None, backend.close)
@@ -0,0 +1,131 @@
+import json
+import pickle
+from typing import Any, Dict, Tuple
+
+# Storage entries are written as:
+#   MAGIC, format version (1 byte), codec name length (1 byte), codec name (ASCII), codec payload.
+# Anything not starting with MAGIC is a raw pickle, which is what MoMMI used to write.
+MAGIC = b"MoMMI\x00"
+FORMAT_VERSION = 1
+
+
+class MStorageFormatError(Exception):
+    """
+    Raised when a stored entry can't be decoded.
+    This is not a KeyError on purpose: the entry exists, so it must not be treated as missing and overwritten.
+    """
+    pass
+
+
+class MStorageCodec(object):
+    """
+    Turns the value of a storage entry into bytes and back.
+    The name goes into the header of every entry it writes, so change it when the payload layout changes.
+    Entries written with a codec that isn't registered anymore can't be read.
+    """
+    name: str = ""
+
+    def encode(self, value: Any) -> bytes:
+        raise NotImplementedError()
+
+    def decode(self, data: bytes) -> Any:
+        raise NotImplementedError()
+
+
+class MPickleCodec(MStorageCodec):
+    """
+    The default, for entries without a codec of their own.
+    """
+    name = "pickle"
+
+    def encode(self, value: Any) -> bytes:
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data: bytes) -> Any:
+        return pickle.loads(data)
+
+
+class MJSONCodec(MStorageCodec):
+    """
+    For entries that are plain JSON data.
+    """
+    name = "json"
+
+    def encode(self, value: Any) -> bytes:
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, data: bytes) -> Any:
+        return json.loads(data.decode("utf-8"))
+
+
+PICKLE_CODEC = MPickleCodec()
+JSON_CODEC = MJSONCodec()
+# Codec of every storage key that has one, by key.
+codecs_by_key: Dict[str, MStorageCodec] = {}
+# Every codec we can read, by name.
+codecs_by_name: Dict[str, MStorageCodec] = {PICKLE_CODEC.name: PICKLE_CODEC, JSON_CODEC.name: JSON_CODEC}
+
+
+def register_codec(key: str, codec: MStorageCodec) -> None:
+    """
+    Makes every storage entry named key, of any server or global, get written with codec.
+    Modules should call this at import time, so the codec is there before their storage gets loaded.
+    """
+    if not codec.name or len(codec.name) > 255:
+        raise ValueError(f"Invalid codec name: {codec.name!r}")
+
+    codecs_by_key[key] = codec
+    codecs_by_name[codec.name] = codec
+
+
+def get_codec(key: str) -> MStorageCodec:
+    return codecs_by_key.get(key, PICKLE_CODEC)
+
+
+def encode_entry(key: str, value: Any) -> bytes:
+    codec = get_codec(key)
+    name = codec.name.encode("ascii")
+    return MAGIC + bytes((FORMAT_VERSION, len(name))) + name + codec.encode(value)
+
+
+def read_header(data: bytes) -> Tuple[str, int]:
+    """
+    Returns the codec name and the offset of the payload of an encoded entry.
+    Raw pickles are reported as the pickle codec at offset 0.
+    """
+    if not data.startswith(MAGIC):
+        return PICKLE_CODEC.name, 0
+
+    offset = len(MAGIC)
+    if len(data) < offset + 2:
+        raise MStorageFormatError("Truncated header.")
+
+    version, length = data[offset], data[offset + 1]
+    if version != FORMAT_VERSION:
+        raise MStorageFormatError(f"Unknown storage format version {version}.")
+
+    offset += 2
+    name = bytes(data[offset:offset + length]).decode("ascii")
+    return name, offset + length
+
+
+def decode_entry(data: bytes) -> Any:
+    name, offset = read_header(data)
+    codec = codecs_by_name.get(name)
+    if codec is None:
+        raise MStorageFormatError(f"Unknown storage codec {name}, is the module registering it loaded?")
+
+    return codec.decode(data[offset:])
+
+
+def is_current(key: str, data: bytes) -> bool:
+    """
+    Whether data is already written with the codec key should be written with.
+    """
+    try:
+        name, _ = read_header(data)
+
+    except MStorageFormatError:
+        return False
+
+    return data.startswith(MAGIC) and name == get_codec(key).name
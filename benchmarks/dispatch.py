@@ -0,0 +1,282 @@
+#!/usr/bin/env python3.6
+"""
+Offline benchmark of message dispatch.
+
+Loads the real modules into a MoMMI that talks to an in-memory fake Discord client,
+pushes a few thousand synthetic messages through on_message and reports throughput,
+on_message latency and per handler latency.
+GitHub API calls get canned answers, so the github_issue embeds are built and sent without any network.
+
+    python3.6 benchmarks/dispatch.py --messages 5000
+    python3.6 benchmarks/dispatch.py --json results.json
+    python3.6 benchmarks/dispatch.py --baseline results.json --max-regression 10
+
+With --baseline the exit code is 1 if throughput dropped more than --max-regression percent.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+# Module detection goes by relative path.
+os.chdir(ROOT)
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.fakediscord import FakeClient, FakeServer, FakeUser, FakeMessage  # noqa: E402
+
+WORDS = ("the", "station", "is", "on", "fire", "again", "who", "let", "clown", "into", "atmos",
+         "engine", "delaminated", "captain", "robusted", "me", "with", "a", "toolbox", "why")
+
+# Fake repository tree for file embeds, one path ends in abcdef0 so [abcdef0] finds something.
+TREE = [{"path": f"Content.Server/{word}/{word.title()}System.cs"} for word in WORDS]
+TREE.append({"path": "Resources/Textures/abcdef0"})
+
+COMMANDS = ("help", "help dice", "markov", "markov station", "2d6", "3d20+4", "rand 1 10",
+            "pick(red, green, blue)", "magic8ball", "dance", "10 m to ft", "ids", "modules")
+
+
+def chatter(rand: random.Random) -> str:
+    return " ".join(rand.choice(WORDS) for _ in range(rand.randint(1, 14)))
+
+
+def make_content(rand: random.Random, mention: str) -> str:
+    roll = rand.random()
+    if roll < 0.6:
+        return chatter(rand)
+
+    if roll < 0.7:
+        return f"when {chatter(rand)}"
+
+    if roll < 0.8:
+        return f"see [{rand.randint(1, 20000)}] and [abcdef0] {chatter(rand)}"
+
+    return f"{mention} {rand.choice(COMMANDS)}"
+
+
+async def fake_github_object(url: str, *, params: Optional[Dict[str, str]] = None, accept: Optional[str] = None) -> Any:
+    """
+    Stands in for MoMMI.Modules.github.get_github_object, answering from canned data instead of the network.
+    Even issue numbers are pull requests, so both embed paths get hit.
+    """
+    await asyncio.sleep(0)
+    path = url.split("github.com", 1)[-1].split("?", 1)[0]
+    parts = path.strip("/").split("/")
+
+    if path.endswith("/reactions"):
+        return [{"content": "+1"}, {"content": "+1"}, {"content": "-1"}]
+
+    if "/branches/" in path:
+        return {"commit": {"sha": "0" * 40}}
+
+    if "/git/trees/" in path:
+        return {"tree": TREE}
+
+    if path.endswith("/check-runs"):
+        return {"check_runs": [
+            {"name": "build", "status": "completed", "conclusion": "success"},
+            {"name": "tests", "status": "in_progress", "conclusion": None},
+        ]}
+
+    if "/pulls/" in path:
+        return {"merged": False, "mergeable": True, "head": {"sha": "1" * 40}}
+
+    if "/issues/" in path:
+        number = int(parts[-1])
+        content = {
+            "number": number,
+            "state": "open",
+            "title": f"Issue {number}",
+            "html_url": f"https://github.com/{parts[1]}/{parts[2]}/issues/{number}",
+            "user": {"login": "benchmark", "avatar_url": "https://example.com/avatar.png"},
+            "body": "The station is on fire again.\n\n<!-- template -->",
+        }
+        if number % 2 == 0:
+            content["pull_request"] = {}
+
+        return content
+
+    raise ValueError(f"No canned GitHub answer for {url}")
+
+
+async def setup(master: Any, loop: asyncio.AbstractEventLoop, storagedir: Path, channels: int) -> FakeServer:
+    from MoMMI.commands import MCommand
+    from MoMMI.scheduler import MDispatchScheduler
+    import re
+
+    client = FakeClient(loop)
+    server = FakeServer("benchmark", channels)
+    owner_role = server.roles[0]
+    client.add_server(server)
+    master.client = client
+
+    master.config.main = {
+        "bot": {"token": "benchmark", "owner": 0, "prefix": "@"},
+        # Don't let send pacing stall handlers, that's not what's being measured.
+        "send": {"rate": 1000000, "per": 1.0},
+    }
+    master.config.modules = {"github": {"token": "benchmark"}}
+    master.config.servers = {
+        "servers": [{
+            "id": int(server.id),
+            "name": "benchmark",
+            "roles": {"OWNER": int(owner_role.id)},
+            "modules": {"github": {"repos": [{"repo": "space-wizards/space-station-14", "prefix_required": False}]}},
+        }],
+    }
+
+    master.storagedir = storagedir
+    master.global_storagedir = storagedir/"__global__"
+    master.global_storagedir.mkdir(parents=True, exist_ok=True)
+
+    MCommand.prefix_re = re.compile(rf"^<@\!?{client.user.id}>\s*")
+
+    await master.load_all_global_storages()
+    await master.reload_modules()
+    # github_issue runs for real, just without talking to GitHub.
+    sys.modules["MoMMI.Modules.github"].get_github_object = fake_github_object  # type: ignore
+    master.scheduler = MDispatchScheduler(master, loop)
+    await master.add_server(server)
+    master.initialized = True
+
+    return server
+
+
+async def wait_idle(master: Any) -> None:
+    scheduler = master.scheduler
+    while scheduler.queued or scheduler.tasks or scheduler.lanes:
+        await scheduler.drain(1)
+        await asyncio.sleep(0)
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def run(args: argparse.Namespace, loop: asyncio.AbstractEventLoop) -> Dict[str, Any]:
+    from MoMMI.master import master
+    from MoMMI.metrics import MMetrics
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        server = await setup(master, loop, Path(tempdir), args.channels)
+
+        rand = random.Random(args.seed)
+        users = [FakeUser(f"user{i}") for i in range(args.users)]
+        for user in users:
+            server.members[user.id] = user
+        mention = f"<@{master.client.user.id}>"
+
+        messages = [FakeMessage(rand.choice(server.channels), rand.choice(users), make_content(rand, mention))
+                    for _ in range(args.messages)]
+
+        # Warm up caches and lazy initialization, then start from clean metrics.
+        for message in messages[:args.warmup]:
+            await master.on_message(message)
+        await wait_idle(master)
+        master.metrics = MMetrics()
+
+        latencies: List[float] = []
+        start = time.perf_counter()
+        for message in messages:
+            before = time.perf_counter()
+            await master.on_message(message)
+            latencies.append((time.perf_counter() - before) * 1000)
+            if args.yield_every and len(latencies) % args.yield_every == 0:
+                await asyncio.sleep(0)
+
+        dispatched = time.perf_counter()
+        await wait_idle(master)
+        finished = time.perf_counter()
+
+        await master.save_all_storage()
+
+    handlers = {}
+    for key, stats in master.metrics.top_handlers("total", len(master.metrics.handlers)):
+        handlers[key] = {
+            "calls": stats.calls,
+            "errors": stats.errors,
+            "p50_ms": round(stats.latency.percentile(50), 3),
+            "p99_ms": round(stats.latency.percentile(99), 3),
+            "mean_ms": round(stats.latency.mean_ms, 4),
+        }
+
+    return {
+        "messages": args.messages,
+        "modules": len(master.modules),
+        "dispatch_seconds": round(dispatched - start, 4),
+        "total_seconds": round(finished - start, 4),
+        "msgs_per_sec": round(args.messages / (finished - start), 1),
+        "on_message_p50_ms": round(percentile(latencies, 50), 4),
+        "on_message_p99_ms": round(percentile(latencies, 99), 4),
+        "sent": master.client.sent,
+        "handlers": handlers,
+    }
+
+
+def report(results: Dict[str, Any]) -> None:
+    print(f"{results['messages']} messages through {results['modules']} modules")
+    print(f"  {results['msgs_per_sec']} msgs/sec ({results['total_seconds']}s, dispatch {results['dispatch_seconds']}s)")
+    print(f"  on_message p50 {results['on_message_p50_ms']}ms, p99 {results['on_message_p99_ms']}ms")
+    print(f"  {results['sent']} messages sent")
+    print()
+    print(f"  {'handler':<40} {'calls':>7} {'errors':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    for key, stats in results["handlers"].items():
+        print(f"  {key:<40} {stats['calls']:>7} {stats['errors']:>7} {stats['p50_ms']:>8} {stats['p99_ms']:>8}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark MoMMI message dispatch without Discord.")
+    parser.add_argument("--messages", type=int, default=5000, help="Amount of messages to dispatch.")
+    parser.add_argument("--warmup", type=int, default=200, help="Messages dispatched before measuring.")
+    parser.add_argument("--channels", type=int, default=8, help="Amount of channels on the fake server.")
+    parser.add_argument("--users", type=int, default=50, help="Amount of fake users talking.")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--yield-every", type=int, default=50,
+                        help="Let the loop run handlers every this many messages, like a real gateway would. 0 to never.")
+    parser.add_argument("--json", type=Path, help="Write the results to this file.")
+    parser.add_argument("--baseline", type=Path, help="Results file of an earlier run to compare against.")
+    parser.add_argument("--max-regression", type=float, default=10,
+                        help="Allowed throughput drop against the baseline, in percent.")
+    parser.add_argument("--verbose", action="store_true", help="Show MoMMI's logging.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    loop = asyncio.get_event_loop()
+    # Some modules print debug output, keep that out of the report.
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        results = loop.run_until_complete(run(args, loop))
+
+    report(results)
+
+    if args.json:
+        with args.json.open("w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with args.baseline.open() as f:
+            baseline = json.load(f)
+
+        change = (results["msgs_per_sec"] - baseline["msgs_per_sec"]) / baseline["msgs_per_sec"] * 100
+        print()
+        print(f"Throughput vs baseline: {change:+.1f}% ({baseline['msgs_per_sec']} -> {results['msgs_per_sec']} msgs/sec)")
+        if change < -args.max_regression:
+            print(f"Regression beyond {args.max_regression}%!")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
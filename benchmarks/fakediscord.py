@@ -0,0 +1,112 @@
+# In-memory stand-ins for the bits of discord.py MoMMI touches,
+# so MoMMI can be driven without a connection to Discord.
+
+import asyncio
+import itertools
+from typing import Any, Dict, List, Optional
+
+_ids = itertools.count(100000000000000000)
+
+
+def new_id() -> str:
+    return str(next(_ids))
+
+
+class FakeRole(object):
+    def __init__(self, name: str) -> None:
+        self.id = new_id()
+        self.name = name
+
+
+class FakeUser(object):
+    def __init__(self, name: str, bot: bool = False, roles: Optional[List[FakeRole]] = None) -> None:
+        self.id = new_id()
+        self.name = name
+        self.nick: Optional[str] = None
+        self.discriminator = "0001"
+        self.bot = bot
+        self.roles = roles or []
+
+
+class FakeChannel(object):
+    def __init__(self, server: "FakeServer", name: str) -> None:
+        self.id = new_id()
+        self.name = name
+        self.server = server
+        self.is_private = False
+
+
+class FakeServer(object):
+    def __init__(self, name: str, channel_count: int) -> None:
+        self.id = new_id()
+        self.name = name
+        self.roles: List[FakeRole] = [FakeRole("@everyone")]
+        self.members: Dict[str, FakeUser] = {}
+        self.channels = [FakeChannel(self, f"channel{i}") for i in range(channel_count)]
+
+    def get_member(self, snowflake: str) -> Optional[FakeUser]:
+        return self.members.get(snowflake)
+
+    def get_member_named(self, name: str) -> Optional[FakeUser]:
+        for member in self.members.values():
+            if member.name == name:
+                return member
+
+        return None
+
+
+class FakeMessage(object):
+    def __init__(self, channel: FakeChannel, author: FakeUser, content: str) -> None:
+        self.id = new_id()
+        self.channel = channel
+        self.server = channel.server
+        self.author = author
+        self.content = content
+        self.attachments: List[Dict[str, Any]] = []
+
+
+class FakeClient(object):
+    """
+    Records everything sent instead of sending it anywhere.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.user = FakeUser("MoMMI", bot=True)
+        self.servers: List[FakeServer] = []
+        self.sent: int = 0
+        self.reactions: int = 0
+
+    def add_server(self, server: FakeServer) -> None:
+        self.servers.append(server)
+
+    def get_server(self, snowflake: str) -> Optional[FakeServer]:
+        for server in self.servers:
+            if server.id == snowflake:
+                return server
+
+        return None
+
+    def get_channel(self, snowflake: str) -> Optional[FakeChannel]:
+        for server in self.servers:
+            for channel in server.channels:
+                if channel.id == snowflake:
+                    return channel
+
+        return None
+
+    async def send_message(self, channel: FakeChannel, content: str = "", **kwargs: Any) -> FakeMessage:
+        self.sent += 1
+        return FakeMessage(channel, self.user, content)
+
+    async def send_file(self, channel: FakeChannel, *args: Any, **kwargs: Any) -> None:
+        self.sent += 1
+
+    async def add_reaction(self, message: FakeMessage, reaction: str) -> None:
+        self.reactions += 1
+
+    async def remove_reaction(self, message: FakeMessage, reaction: str, member: Any = None) -> None:
+        pass
+
+    async def logout(self) -> None:
+        pass
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3.6
+"""
+Offline benchmark of storage.
+
+Generates synthetic markov chains, reminder heaps and arbitrary blobs at increasing sizes
+and times saving and loading them through MStorage, the same code server, channel and global storage go through.
+Every storage backend is measured, with the codec the owning module registers for the key, if any.
+
+    python3.6 benchmarks/storage.py
+    python3.6 benchmarks/storage.py --sizes 1000,10000,100000,1000000 --kinds markov --backends sqlite
+    python3.6 benchmarks/storage.py --json results.json
+    python3.6 benchmarks/storage.py --baseline results.json --max-regression 20
+
+Peak memory is what tracemalloc sees on top of the value itself while saving, and including the value while loading.
+Encoding is done on the loop by default so it's traced too;
+pass --offload-threshold 1000 to time saves the way MoMMI does them by default, forked encoding isn't traced then.
+
+With --baseline the exit code is 1 if save or load time of any case got more than --max-regression percent slower.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+# Module detection goes by relative path.
+os.chdir(ROOT)
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.fakediscord import FakeClient  # noqa: E402
+
+KEYS = {
+    "markov": "markov",
+    "reminders": "reminder_queue",
+    "blob": "benchmark_blob",
+}
+
+
+def word(rand: random.Random) -> str:
+    return "".join(rand.choice(string.ascii_lowercase) for _ in range(rand.randint(1, 10)))
+
+
+def make_markov(rand: random.Random, size: int) -> Any:
+    """
+    A chain with size first words, drawn from a vocabulary a bit larger than that like real chat.
+    """
+    from MoMMI.Modules.markov import partial
+
+    vocabulary = [word(rand) for _ in range(size + size // 4 + 1)]
+    chain: Any = defaultdict(partial)
+    for first in vocabulary[:size]:
+        for _ in range(rand.randint(1, 8)):
+            chain[first][rand.choice(vocabulary)] += rand.randint(1, 20)
+
+    return chain
+
+
+def make_reminders(rand: random.Random, size: int) -> Any:
+    import heapq
+    import pytz
+    from MoMMI.types import SnowflakeID
+
+    now = datetime.now(pytz.utc)
+    heap: List[Any] = []
+    for uid in range(size):
+        when = now + timedelta(seconds=rand.randint(0, 60 * 60 * 24 * 365))
+        text = " ".join(word(rand) for _ in range(rand.randint(1, 12)))
+        ids = (SnowflakeID(rand.getrandbits(62)) for _ in range(3))
+        heapq.heappush(heap, (when, text, *ids, uid))
+
+    return heap
+
+
+def make_blob(rand: random.Random, size: int) -> Any:
+    """
+    The kind of nested data modules stick in storage without a codec of their own.
+    """
+    return {
+        f"{word(rand)}{i}": [rand.randint(0, 2 ** 40), word(rand), rand.random(), {"seen": rand.random() < 0.5}]
+        for i in range(size)
+    }
+
+
+GENERATORS: Dict[str, Callable[[random.Random, int], Any]] = {
+    "markov": make_markov,
+    "reminders": make_reminders,
+    "blob": make_blob,
+}
+
+
+def import_codec_modules() -> None:
+    """
+    Imports the modules owning the benchmarked keys, so the codecs they register are used.
+    """
+    from MoMMI.master import master
+    # Handlers registered while importing get parked like during a module reload, nothing ever runs them here.
+    master.reloading_modules = True
+    import MoMMI.Modules.markov  # noqa: F401
+    import MoMMI.Modules.reminders  # noqa: F401
+
+
+@contextmanager
+def traced(peaks: List[int]) -> Iterator[None]:
+    """
+    Runs a block with tracemalloc on and appends the peak to peaks.
+    tracemalloc.reset_peak() is 3.9+, so it's restarted each time instead.
+    """
+    tracemalloc.start()
+    try:
+        yield
+
+    finally:
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+
+async def run_case(master: Any, directory: Path, key: str, value: Any, repeat: int) -> Dict[str, Any]:
+    from MoMMI.storage import MStorage, open_backend
+
+    saves: List[float] = []
+    loads: List[float] = []
+    opens: List[float] = []
+    save_peaks: List[int] = []
+    load_peaks: List[int] = []
+
+    storage = MStorage()
+    await storage.open(open_backend(master, directory), master)
+    storage.set(key, value)
+    for _ in range(repeat):
+        with traced(save_peaks):
+            start = time.perf_counter()
+            await storage.save(key)
+            saves.append(time.perf_counter() - start)
+
+    size = storage.sizes[key]
+    await storage.close()
+
+    for _ in range(repeat):
+        fresh = MStorage()
+        with traced(load_peaks):
+            start = time.perf_counter()
+            await fresh.open(open_backend(master, directory), master)
+            opened = time.perf_counter()
+            await fresh.load(key)
+            loads.append(time.perf_counter() - opened)
+            opens.append(opened - start)
+
+            if not fresh.has(key):
+                raise RuntimeError(f"Failed to load {key} back.")
+
+        await fresh.close()
+
+    return {
+        "bytes": size,
+        "save_ms": round(min(saves) * 1000, 2),
+        "load_ms": round(min(loads) * 1000, 2),
+        "open_ms": round(min(opens) * 1000, 2),
+        "save_peak_kib": round(max(save_peaks) / 1024, 1),
+        "load_peak_kib": round(max(load_peaks) / 1024, 1),
+    }
+
+
+async def run(args: argparse.Namespace, loop: asyncio.AbstractEventLoop) -> List[Dict[str, Any]]:
+    from MoMMI.master import master
+
+    master.client = FakeClient(loop)
+    import_codec_modules()
+
+    results = []
+    rand = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tempdir:
+        for kind in args.kinds:
+            key = KEYS[kind]
+            for size in args.sizes:
+                value = GENERATORS[kind](rand, size)
+                for backend in args.backends:
+                    master.config.main = {"storage": {
+                        "backend": backend,
+                        "fsync": args.fsync,
+                        "offload_threshold": args.offload_threshold,
+                    }}
+                    # The semaphore is made by the first storage opened, with the config of then.
+                    master.storage_io = None
+
+                    directory = Path(tempdir)/f"{kind}-{size}-{backend}"
+                    result = await run_case(master, directory, key, value, args.repeat)
+                    result.update(kind=kind, size=size, backend=backend)
+                    results.append(result)
+
+    return results
+
+
+def case_name(result: Dict[str, Any]) -> Tuple[str, int, str]:
+    return result["kind"], result["size"], result["backend"]
+
+
+def report(results: List[Dict[str, Any]]) -> None:
+    print(f"{'kind':<10} {'size':>8} {'backend':<7} {'bytes':>11} {'save ms':>9} {'load ms':>9}"
+          f" {'open ms':>8} {'save peak KiB':>14} {'load peak KiB':>14}")
+    for result in results:
+        print(f"{result['kind']:<10} {result['size']:>8} {result['backend']:<7}"
+              f" {result['bytes']:>11} {result['save_ms']:>9} {result['load_ms']:>9} {result['open_ms']:>8}"
+              f" {result['save_peak_kib']:>14} {result['load_peak_kib']:>14}")
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], max_regression: float) -> bool:
+    """
+    Prints how every case that's in both runs changed. Returns whether any got too much slower.
+    """
+    old = {case_name(result): result for result in baseline}
+    regressed = False
+    print()
+    for result in results:
+        before = old.get(case_name(result))
+        if before is None:
+            continue
+
+        for measure in ("save_ms", "load_ms"):
+            if not before[measure]:
+                continue
+
+            change = (result[measure] - before[measure]) / before[measure] * 100
+            if change > max_regression:
+                regressed = True
+                print(f"{' '.join(map(str, case_name(result)))} {measure}: {change:+.1f}%"
+                      f" ({before[measure]} -> {result[measure]})")
+
+    if regressed:
+        print(f"Regression beyond {max_regression}%!")
+
+    else:
+        print(f"No case got more than {max_regression}% slower than the baseline.")
+
+    return regressed
+
+
+def main() -> None:
+    def csv(kind: Callable[[str], Any]) -> Callable[[str], List[Any]]:
+        return lambda value: [kind(part) for part in value.split(",") if part]
+
+    parser = argparse.ArgumentParser(description="Benchmark MoMMI storage saving and loading.")
+    parser.add_argument("--sizes", type=csv(int), default=[1000, 10000, 100000],
+                        help="Comma separated amounts of markov words, reminders or blob entries.")
+    parser.add_argument("--kinds", type=csv(str), default=list(GENERATORS), help="Any of markov,reminders,blob.")
+    parser.add_argument("--backends", type=csv(str), default=["file", "sqlite"], help="Any of file,sqlite.")
+    parser.add_argument("--repeat", type=int, default=3, help="Times to save and load every case, the best is kept.")
+    parser.add_argument("--fsync", choices=("always", "never"), default="never",
+                        help="storage.fsync to run with. Off by default so disk flushes don't drown out the rest.")
+    parser.add_argument("--offload-threshold", type=int, default=2 ** 62,
+                        help="storage.offload_threshold to run with. Encodes on the loop by default.")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--json", type=Path, help="Write the results to this file.")
+    parser.add_argument("--baseline", type=Path, help="Results file of an earlier run to compare against.")
+    parser.add_argument("--max-regression", type=float, default=20,
+                        help="Allowed save or load time increase against the baseline, in percent.")
+    parser.add_argument("--verbose", action="store_true", help="Show MoMMI's logging.")
+    args = parser.parse_args()
+
+    for name, choices in (("kinds", GENERATORS), ("backends", ("file", "sqlite"))):
+        for value in getattr(args, name):
+            if value not in choices:
+                parser.error(f"Unknown {name[:-1]} {value}, expected any of {', '.join(choices)}.")
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(args, loop))
+    report(results)
+
+    if args.json:
+        with args.json.open("w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with args.baseline.open() as f:
+            baseline = json.load(f)
+
+        if compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
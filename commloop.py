@@ -28,5 +28,101 @@ def MoMMI(address, key, type, meta, content):
         if ret != 0:
             raise IOError(f"MoMMI returned non-zero code {ret}")
 
+
+# This one keeps the connection open, for sending a lot of messages.
+# MoMMI closes it after commloop.idle_timeout seconds of nothing, it gets reopened on the next send.
+class MoMMIConnection(object):
+    def __init__(self, address, key, timeout=5):
+        self.address = address
+        self.key = key
+        self.timeout = timeout
+        self.socket = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def pack(self, type, meta, content):
+        import hmac
+        import json
+        import struct
+        from hashlib import sha512
+
+        msg = json.dumps({
+            "type": type,
+            "meta": meta,
+            "cont": content
+        }).encode("UTF-8")  # type: bytes
+        h = hmac.new(self.key, msg, sha512)
+        return b"\x30\x05" + h.digest() + struct.pack("!I", len(msg)) + msg
+
+    def send(self, type, meta, content):
+        self.send_many([(type, meta, content)])
+
+    def send_many(self, messages):
+        """
+        Sends all messages at once, then waits for all their return codes.
+        messages is a list of (type, meta, content).
+        """
+        from socket import socket, AF_INET, SOCK_STREAM
+
+        packets = b"".join(self.pack(*message) for message in messages)
+        # A connection MoMMI closed for idling only shows that on use.
+        # Nothing on it got through then, so it's safe to send everything again on a new one.
+        for attempt in range(2):
+            reused = self.socket is not None
+            if self.socket is None:
+                self.socket = socket(AF_INET, SOCK_STREAM)
+                self.socket.settimeout(self.timeout)
+                self.socket.connect(self.address)
+
+            try:
+                self.socket.sendall(packets)
+                codes = self.read_codes(len(messages))
+
+            except (ConnectionError, EOFError):
+                self.close()
+                if reused and attempt == 0:
+                    continue
+
+                raise
+
+            break
+
+        failed = [(index, code) for index, code in enumerate(codes) if code != 0]
+        if len(codes) < len(messages) and not failed:
+            self.close()
+            raise IOError(f"MoMMI only confirmed {len(codes)} of {len(messages)} messages.")
+
+        if failed:
+            # Errors other than a bad message make MoMMI drop the connection.
+            self.close()
+            raise IOError(f"MoMMI returned non-zero codes (index, code): {failed}")
+
+    def read_codes(self, count):
+        codes = b""
+        while len(codes) < count:
+            data = self.socket.recv(count - len(codes))
+            if not data:
+                if codes:
+                    # MoMMI stops reading after an error, so return what we have.
+                    break
+
+                raise EOFError("MoMMI closed the connection.")
+
+            codes += data
+            if codes[-1] not in (0, 2):
+                break
+
+        return list(codes)
+
+
 def derp():
     pass
@@ -4,7 +4,7 @@ import asyncio
 import logging
 import sys
 from pathlib import Path
-from MoMMI.logsetup import setup_logs
+from MoMMI.logsetup import setup_logs, DEFAULT_MAX_BYTES, DEFAULT_MAX_AGE
 
 # Do this BEFORE we import master, because it does a lot of event loop stuff.
 if sys.platform == "win32":
@@ -27,8 +27,6 @@ def main() -> None:
         logging.critical("You need at least Python 3.6 to run MoMMI.")
         sys.exit(1)
 
-    setup_logs()
-
     parser = argparse.ArgumentParser()
     parser.add_argument("--config-dir", "-c",
                         default="./config",
@@ -42,8 +40,36 @@ def main() -> None:
                         dest="data",
                         type=Path)
 
+    parser.add_argument("--file-log-level",
+                        default="DEBUG",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Minimum level of messages written to all.log.",
+                        dest="file_log_level")
+
+    parser.add_argument("--log-max-size",
+                        default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help="Size in MiB after which log files get rotated. 0 to disable.",
+                        dest="log_max_size",
+                        type=int)
+
+    parser.add_argument("--log-max-age",
+                        default=DEFAULT_MAX_AGE // (60 * 60),
+                        help="Age in hours after which log files get rotated. 0 to disable.",
+                        dest="log_max_age",
+                        type=int)
+
+    parser.add_argument("--no-compress-logs",
+                        action="store_false",
+                        help="Don't gzip rotated log files.",
+                        dest="compress_logs")
+
     args = parser.parse_args()
 
+    setup_logs(getattr(logging, args.file_log_level),
+               args.log_max_size * 1024 * 1024,
+               args.log_max_age * 60 * 60,
+               args.compress_logs)
+
     master.start(args.config, args.data)
 
 
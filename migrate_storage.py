@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+One-shot conversion of every stored entry in the storage dir to the current storage format,
+see MoMMI/storageformat.py. Entries are converted in parallel, one process per CPU by default.
+
+    python3 migrate_storage.py --storage-dir ./data
+
+Run this while MoMMI is stopped.
+Converted files keep a copy of their old contents next to them as .<name>.bak, unless --no-backup is passed.
+SQLite databases are converted in place, so copy them first if you want a backup.
+"""
+
+import argparse
+import importlib
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, Future
+from pathlib import Path
+from typing import Any, List, Tuple
+
+logger = logging.getLogger("migrate_storage")
+codec_modules_imported = False
+
+
+def import_codec_modules() -> None:
+    """
+    Imports every module so they register their codecs, both to read their old pickles and to write their new format.
+    """
+    global codec_modules_imported
+    if codec_modules_imported:
+        return
+
+    codec_modules_imported = True
+    from MoMMI.master import master
+    # Handlers registered while importing get parked like during a module reload, nothing ever runs them here.
+    master.reloading_modules = True
+
+    root = Path("MoMMI")/"Modules"
+    for path in sorted(root.rglob("*.py")):
+        if path.name == "__init__.py":
+            continue
+
+        name = ".".join(path.relative_to(root).with_suffix("").parts)
+        try:
+            importlib.import_module(f"MoMMI.Modules.{name}")
+
+        except:
+            logger.warning(f"Can't import module {name}, its storages will be stored as pickle.", exc_info=True)
+
+
+def convert(key: str, data: bytes) -> bytes:
+    from MoMMI.storageformat import decode_entry, encode_entry
+    import_codec_modules()
+
+    value = decode_entry(data)
+    new = encode_entry(key, value)
+    # Make sure we can read back what we wrote before anything gets replaced.
+    decode_entry(new)
+    return new
+
+
+def find_backends(storagedir: Path) -> List[Tuple[Path, Any]]:
+    from MoMMI.storage import MStorageBackend, MFileStorageBackend, MSQLiteStorageBackend
+    backends: List[Tuple[Path, MStorageBackend]] = []
+    for path in sorted(storagedir.iterdir()):
+        if path.name == "__metrics__":
+            continue
+
+        if path.is_dir():
+            backends.append((path, MFileStorageBackend(path)))
+
+        elif path.suffix == ".sqlite3":
+            backends.append((path, MSQLiteStorageBackend(path)))
+
+    return backends
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Convert MoMMI storage to the current storage format.")
+    parser.add_argument("--storage-dir", "-s", default="./data", type=Path, dest="data",
+                        help="The storage dir MoMMI runs with.")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(), help="Amount of conversions to run at once.")
+    parser.add_argument("--dry-run", action="store_true", help="Convert, but don't write anything.")
+    parser.add_argument("--no-backup", action="store_true", help="Don't keep the old contents of converted files.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    storagedir: Path = args.data.resolve()
+
+    # Module detection goes by relative path, just like MoMMI itself.
+    os.chdir(Path(__file__).resolve().parent)
+    sys.path.insert(0, ".")
+    from MoMMI.storage import MFileStorageBackend
+    from MoMMI.storageformat import is_current
+    import_codec_modules()
+
+    start = time.monotonic()
+    converted = skipped = failed = 0
+    before = after = 0
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for path, backend in find_backends(storagedir):
+            jobs: List[Tuple[str, bytes, Future]] = []
+            for key in backend.keys():
+                data = backend.read(key)
+                if is_current(key, data):
+                    skipped += 1
+                    continue
+
+                jobs.append((key, data, pool.submit(convert, key, data)))
+
+            for key, data, future in jobs:
+                try:
+                    new = future.result()
+
+                except:
+                    logger.exception(f"Failed to convert {path.name}/{key}, leaving it alone.")
+                    failed += 1
+                    continue
+
+                logger.info(f"{path.name}/{key}: {len(data)} -> {len(new)} bytes")
+                converted += 1
+                before += len(data)
+                after += len(new)
+                if args.dry_run:
+                    continue
+
+                if isinstance(backend, MFileStorageBackend) and not args.no_backup:
+                    (path/f".{key}.bak").write_bytes(data)
+
+                backend.write(key, new)
+
+            backend.close()
+
+    logger.info(f"Converted {converted} entries ({before} -> {after} bytes), {skipped} already current, {failed} failed"
+                f" in {time.monotonic() - start:.1f}s.{' Dry run, nothing written.' if args.dry_run else ''}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()